@@ -1 +1 @@
-from . import database, chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, legend, graph, clef, audio, text, order, composite, movie
+from . import database, connection, recompute, columns, render, rasterize, canvas, sprites, cache, chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, legend, graph, clef, audio, text, order, composite, stream, movie
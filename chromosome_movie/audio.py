@@ -88,7 +88,12 @@ class Audio():
             print('config.audio_pipe is set.  Not creating WAV.')
             return
         self.cfg.audio_wav.parent.mkdir(parents=True, exist_ok=True)
-        command = [
+        command = self.wav_command()
+        print('"' + '" "'.join(command) + '"')
+        subprocess.call(command)
+
+    def wav_command(self):
+        return [
             os.fspath(self.cfg.timidity),
             '-OwS', # Output WAV format, stereo.
             '-o', os.fspath(self.cfg.audio_wav),
@@ -97,6 +102,4 @@ class Audio():
             '-s', str(self.cfg.audio_samplerate),
             os.fspath(self.cfg.audio_midi),
         ]
-        print('"' + '" "'.join(command) + '"')
-        subprocess.call(command)
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of composited foreground frames.
+#
+# Same idea as population_counts_match_variant_id, one level up: lots of
+# consecutive frames come out as byte-identical SVG, so each frame's SVG is
+# hashed and only the first frame with a given hash gets rendered.  Every
+# frame's PNG is then a hard link to frame_cache_path/<hash>.png.  The cache
+# folder is shared between parts, so a frame that already exists from an
+# earlier part or run isn't rendered at all.
+#
+# write_svg() records each frame's hash in a manifest next to the PNGs
+# (frames.manifest, "frame_number hash" lines), and write_png() works from
+# that.  The hash also covers the rasterizer and the size and mtime of any
+# files the SVG links to (the clef and the world map), so regenerating those
+# or switching renderer doesn't bring back old frames.  Each rendered PNG
+# goes into the cache as soon as it's done, so a run that dies partway
+# through doesn't have to render those frames again.
+
+import sys
+import os
+import re
+import collections
+import urllib.parse
+
+from . import svg2png
+
+# External files an SVG refers to, without any #fragment.
+href = re.compile(r'xlink:href="([^"#]+)')
+
+class FrameCache():
+
+    def __init__(self, cfg, layercfg):
+        self.cfg = cfg
+        self.layercfg = layercfg
+        self.folder = self.cfg.frame_cache_path
+        self.manifest_path = self.layercfg.png.parent/'frames.manifest'
+        self.seen = set()
+        self.manifest = None
+        # PNG name -> hash for frames handed to the renderer by pending().
+        self.rendering = {}
+        self.stored = 0
+        # Link -> "link size mtime", looked up once per run.
+        self.stamps = {}
+
+    def cache_path(self, frame_digest):
+        return self.folder/f'{frame_digest}.png'
+
+    def png_path(self, frame_number):
+        return str(self.layercfg.png) % frame_number
+
+    def open(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.layercfg.png.parent.mkdir(parents=True, exist_ok=True)
+        self.manifest = open(self.manifest_path, 'w', encoding='utf-8')
+        self.seen.clear()
+        self.stamps.clear()
+
+    def stamp(self, link):
+        if link not in self.stamps:
+            path = self.layercfg.svg.parent/urllib.parse.unquote(link)
+            try:
+                stat = os.stat(path)
+                self.stamps[link] = f'{link} {stat.st_size} {stat.st_mtime_ns}'
+            except OSError:
+                self.stamps[link] = f'{link} missing'
+        return self.stamps[link]
+
+    def digest(self, svg):
+        '''
+        Hash of everything that goes into a frame's PNG.
+        '''
+        parts = [self.cfg.rasterizer, svg]
+        parts.extend(self.stamp(link) for link in sorted(set(href.findall(svg))))
+        return svg2png.digest('\n'.join(parts).encode('utf-8'))
+
+    def add(self, frame_number, svg):
+        '''
+        Record a frame.  Returns True if its SVG needs writing, i.e. it's the
+        first frame with this content and there's no cached PNG for it yet.
+        '''
+        frame_digest = self.digest(svg)
+        self.manifest.write(f'{frame_number} {frame_digest}\n')
+        if frame_digest in self.seen:
+            return False
+        self.seen.add(frame_digest)
+        return not svg2png.png_complete(self.cache_path(frame_digest))
+
+    def close(self):
+        self.manifest.close()
+        self.manifest = None
+
+    def read_manifest(self):
+        with open(self.manifest_path, encoding='utf-8') as lines:
+            for line in lines:
+                frame_number, frame_digest = line.split()
+                yield int(frame_number), frame_digest
+
+    def pending(self):
+        '''
+        Frame numbers that have to be rendered: one per hash not yet in the
+        cache.
+        '''
+        seen = set()
+        self.rendering.clear()
+        self.stored = 0
+        for frame_number, frame_digest in self.read_manifest():
+            if frame_digest in seen:
+                continue
+            seen.add(frame_digest)
+            if not svg2png.png_complete(self.cache_path(frame_digest)):
+                # The old PNG may be a hard link into the cache; don't let
+                # the renderer write through it.
+                png = self.png_path(frame_number)
+                if os.path.exists(png):
+                    os.remove(png)
+                self.rendering[os.path.basename(png)] = frame_digest
+                yield frame_number
+
+    def store(self, png):
+        '''
+        Called as each frame from pending() is rendered: put its PNG in the
+        cache straight away.
+        '''
+        frame_digest = self.rendering.pop(os.path.basename(png), None)
+        if frame_digest is None or not svg2png.png_complete(png):
+            return
+        cached = self.cache_path(frame_digest)
+        if not os.path.exists(cached):
+            os.link(png, cached)
+            self.stored += 1
+
+    def link(self):
+        '''
+        After rendering: put newly rendered PNGs into the cache, hard-link
+        every frame's PNG to its cached copy, and report hit rates.
+        '''
+        frames = 0
+        rendered = self.stored
+        counts = collections.Counter()
+        for frame_number, frame_digest in self.read_manifest():
+            frames += 1
+            counts[frame_digest] += 1
+            cached = self.cache_path(frame_digest)
+            png = self.png_path(frame_number)
+            if not os.path.exists(cached):
+                if not svg2png.png_complete(png):
+                    raise Exception(f'Frame {frame_number} was not rendered: {png}')
+                os.link(png, cached)
+                rendered += 1
+            if os.path.exists(png):
+                if os.path.samefile(png, cached):
+                    continue
+                os.remove(png)
+            os.link(cached, png)
+
+        hits = frames - rendered
+        report = f'Part {self.cfg.part}: {frames} frames, {len(counts)} distinct, {rendered} rendered, {hits} cache hits ({hits / max(frames, 1):.1%})'
+        sys.stderr.write(report + '\n')
+        sys.stderr.flush()
+        with open(self.folder/'stats.txt', 'a', encoding='utf-8') as stats:
+            stats.write(f'{self.layercfg.png.parent} {report}\n')
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Immediate-mode drawing straight into an RGBA NumPy buffer.
+#
+# The dynamic foreground layers are nothing but circles and rectangles, so
+# rather than write them out as SVG and have something parse and rasterize
+# them again every frame, layers with a draw(canvas, variant) method paint
+# directly into a Canvas.  Anything a layer can't draw itself (text, mostly)
+# comes back from draw() as an SVG snippet, and Composite.Foreground hands
+# those to the rasterizer in layer order.
+#
+# The buffer is float32 premultiplied RGBA in 0..1, so compositing is just
+# src + dst * (1 - src_alpha).  Coverage is computed per pixel from the
+# shape's distance, which gives about one pixel of antialiasing - close to
+# what Inkscape does for these shapes, not identical.
+#
+# SVG filters (drop shadows) aren't supported; layers should fall back to
+# SVG for anything that uses them.
+#
+# Rectangles in pixels are (x0, y0, x1, y1), ends exclusive.
+
+import numpy
+
+def parse_color(color):
+    if color is None or color == 'none':
+        return None
+    import PIL.ImageColor
+    return tuple(c / 255 for c in PIL.ImageColor.getrgb(color)[:3])
+
+
+def parse_style(style='', **attributes):
+    '''
+    Fill and stroke paints from an SVG style string plus any presentation
+    attributes (fill='orange', stroke_width=4, ...), with the style winning
+    as it does in SVG.  Paints are (r, g, b, a) or None.
+    '''
+    properties = {key.replace('_', '-'): value for key, value in attributes.items()}
+    for declaration in style.split(';'):
+        if ':' in declaration:
+            key, value = declaration.split(':', 1)
+            properties[key.strip()] = value.strip()
+
+    paints = {}
+    for name, default in (('fill', 'black'), ('stroke', 'none')):
+        color = parse_color(str(properties.get(name, default)))
+        if color:
+            opacity = float(properties.get(f'{name}-opacity', 1))
+            paints[name] = color + (opacity,)
+        else:
+            paints[name] = None
+    stroke_width = str(properties.get('stroke-width', 1)).replace('px', '')
+    return paints['fill'], paints['stroke'], float(stroke_width)
+
+
+class Canvas():
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = numpy.zeros((height, width, 4), dtype=numpy.float32)
+        self.left = 0
+        self.top = 0
+        self.scale = 1
+        self.clip = (0, 0, width, height)
+
+    def set_clip(self, rect=None):
+        'Limit all drawing to a pixel rectangle, or lift the limit.'
+        frame = (0, 0, self.width, self.height)
+        if rect:
+            # Nothing gets drawn if the rectangle is entirely off the canvas.
+            self.clip = intersection(rect, frame) or (0, 0, 0, 0)
+        else:
+            self.clip = frame
+
+    def clear(self):
+        x0, y0, x1, y1 = self.clip
+        self.pixels[y0:y1, x0:x1] = 0
+
+    def transform(self, left=0, top=0, scale=1):
+        'Same meaning as the translate/scale that Composite wraps layers in.'
+        self.left = left
+        self.top = top
+        self.scale = scale
+
+    def point(self, x, y):
+        return self.left + x * self.scale, self.top + y * self.scale
+
+    def window(self, x0, y0, x1, y1):
+        'Integer pixel bounds clipped to the canvas, or None if off it.'
+        clip_x0, clip_y0, clip_x1, clip_y1 = self.clip
+        x0 = max(int(numpy.floor(x0)), clip_x0, 0)
+        y0 = max(int(numpy.floor(y0)), clip_y0, 0)
+        x1 = min(int(numpy.ceil(x1)) + 1, clip_x1, self.width)
+        y1 = min(int(numpy.ceil(y1)) + 1, clip_y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def paint(self, bounds, coverage, color):
+        x0, y0, x1, y1 = bounds
+        red, green, blue, alpha = color
+        source = coverage[..., None] * (alpha * numpy.array((red, green, blue, 1), dtype=numpy.float32))
+        target = self.pixels[y0:y1, x0:x1]
+        target *= 1 - source[..., 3:]
+        target += source
+
+    def circle(self, cx, cy, r, fill=None, stroke=None, stroke_width=0):
+        cx, cy = self.point(cx, cy)
+        r *= self.scale
+        half = stroke_width * self.scale / 2 if stroke else 0
+        reach = r + half + 1
+        bounds = self.window(cx - reach, cy - reach, cx + reach, cy + reach)
+        if not bounds:
+            return
+        x0, y0, x1, y1 = bounds
+        # Distance from the circle center to each pixel center.
+        xs = numpy.arange(x0, x1, dtype=numpy.float32) + 0.5 - cx
+        ys = numpy.arange(y0, y1, dtype=numpy.float32) + 0.5 - cy
+        distance = numpy.hypot(xs[None, :], ys[:, None])
+        if fill:
+            self.paint(bounds, numpy.clip(r - distance + 0.5, 0, 1), fill)
+        if stroke:
+            self.paint(bounds, numpy.clip(half - numpy.abs(distance - r) + 0.5, 0, 1), stroke)
+
+    def rect(self, x, y, width, height, fill=None, stroke=None, stroke_width=0):
+        if fill:
+            self.fill_rect(x, y, width, height, fill)
+        if stroke and stroke_width:
+            # Four strips centered on the edges, not overlapping at the
+            # corners.
+            half = stroke_width / 2
+            self.fill_rect(x - half, y - half, width + stroke_width, stroke_width, stroke)
+            self.fill_rect(x - half, y + height - half, width + stroke_width, stroke_width, stroke)
+            self.fill_rect(x - half, y + half, stroke_width, height - stroke_width, stroke)
+            self.fill_rect(x + width - half, y + half, stroke_width, height - stroke_width, stroke)
+
+    def fill_rect(self, x, y, width, height, fill):
+        x0, y0 = self.point(x, y)
+        x1, y1 = self.point(x + width, y + height)
+        bounds = self.window(x0, y0, x1, y1)
+        if not bounds or width <= 0 or height <= 0:
+            return
+        # Fractional coverage along each axis for the edge pixels.
+        xs = numpy.arange(bounds[0], bounds[2], dtype=numpy.float32)
+        ys = numpy.arange(bounds[1], bounds[3], dtype=numpy.float32)
+        x_coverage = numpy.clip(numpy.minimum(xs + 1, x1) - numpy.maximum(xs, x0), 0, 1)
+        y_coverage = numpy.clip(numpy.minimum(ys + 1, y1) - numpy.maximum(ys, y0), 0, 1)
+        self.paint(bounds, y_coverage[:, None] * x_coverage[None, :], fill)
+
+    def composite(self, rgba):
+        '''
+        Lay a straight-alpha uint8 RGBA image (same size as the canvas) over
+        what's been drawn so far.
+        '''
+        source = rgba.astype(numpy.float32) / 255
+        source[..., :3] *= source[..., 3:]
+        self.pixels *= 1 - source[..., 3:]
+        self.pixels += source
+
+    def blit(self, rgba, left, top):
+        '''
+        Lay a straight-alpha uint8 RGBA sprite over the canvas with its top
+        left corner at pixel (left, top), clipping whatever hangs off.
+        '''
+        height, width = rgba.shape[:2]
+        clip_x0, clip_y0, clip_x1, clip_y1 = self.clip
+        x0, y0 = max(left, clip_x0, 0), max(top, clip_y0, 0)
+        x1, y1 = min(left + width, clip_x1, self.width), min(top + height, clip_y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        source = rgba[y0 - top:y1 - top, x0 - left:x1 - left].astype(numpy.float32) / 255
+        source[..., :3] *= source[..., 3:]
+        target = self.pixels[y0:y1, x0:x1]
+        target *= 1 - source[..., 3:]
+        target += source
+
+    def rgba(self):
+        'Straight-alpha uint8 RGBA, as PNG and ffmpeg expect.'
+        alpha = self.pixels[..., 3:]
+        colour = numpy.divide(self.pixels[..., :3], alpha, out=numpy.zeros_like(self.pixels[..., :3]), where=alpha > 0)
+        return numpy.rint(numpy.concatenate((colour, alpha), axis=2) * 255).astype(numpy.uint8)
+
+    def save(self, path):
+        import PIL.Image
+        PIL.Image.fromarray(self.rgba(), 'RGBA').save(path)
+
+
+def union(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def intersection(a, b):
+    'The overlap of two rectangles, or None.'
+    if not a or not b:
+        return None
+    rect = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if rect[0] >= rect[2] or rect[1] >= rect[3]:
+        return None
+    return rect
+
+
+def intersects(a, b):
+    return a and b and a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def area(rect):
+    return (rect[2] - rect[0]) * (rect[3] - rect[1]) if rect else 0
+
+
+class Recorder():
+
+    '''
+    Stands in for a Canvas in a layer's draw(): keeps the calls instead of
+    painting, so the compositor can compare them against the previous frame,
+    work out the pixels they cover, and replay them onto a Canvas later.
+    '''
+
+    def __init__(self):
+        self.ops = []
+        # Whether the layer's leftover SVG goes under the recorded shapes
+        # rather than over them.
+        self.svg_first = False
+        self.left = 0
+        self.top = 0
+        self.scale = 1
+        self.bbox = None
+
+    def transform(self, left=0, top=0, scale=1):
+        self.left = left
+        self.top = top
+        self.scale = scale
+
+    def cover(self, x0, y0, x1, y1):
+        # Same rounding as Canvas.window(), in frame pixels.
+        rect = (
+            int(numpy.floor(self.left + x0 * self.scale)),
+            int(numpy.floor(self.top + y0 * self.scale)),
+            int(numpy.ceil(self.left + x1 * self.scale)) + 1,
+            int(numpy.ceil(self.top + y1 * self.scale)) + 1,
+        )
+        self.bbox = union(self.bbox, rect)
+
+    def circle(self, cx, cy, r, fill=None, stroke=None, stroke_width=0):
+        self.ops.append(((self.left, self.top, self.scale), 'circle', (cx, cy, r, fill, stroke, stroke_width)))
+        reach = r + (stroke_width / 2 if stroke else 0) + 1 / self.scale
+        self.cover(cx - reach, cy - reach, cx + reach, cy + reach)
+
+    def rect(self, x, y, width, height, fill=None, stroke=None, stroke_width=0):
+        self.ops.append(((self.left, self.top, self.scale), 'rect', (x, y, width, height, fill, stroke, stroke_width)))
+        half = stroke_width / 2 if stroke else 0
+        self.cover(x - half, y - half, x + width + half, y + height + half)
+
+    def replay(self, canvas):
+        for transform, method, arguments in self.ops:
+            canvas.transform(*transform)
+            getattr(canvas, method)(*arguments)
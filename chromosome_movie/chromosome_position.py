@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
-import sqlite3
 
 from . import svg2png
+from . import connection
+from . import canvas
 
 class ChromosomePosition():
 
@@ -11,7 +12,7 @@ class ChromosomePosition():
         self.layercfg = self.cfg.layers.chromosome_position
 
 
-        self.database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
+        self.database = connection.readonly(self.cfg)
         self.cursor = self.database.cursor()
 
         self.cursor.execute('SELECT map_rate, map_offset FROM chromosome WHERE name=?', (self.cfg.chromosome,))
@@ -24,17 +25,23 @@ class ChromosomePosition():
 
 
     def circle(self, x, y):
-        # TODO: Make this into a configurable style.
-        return f'''
- <circle cx="{x}" cy="{y}" r="16" fill="orange" stroke="red" stroke-width="4.0"/>
- <circle cx="{x}" cy="{y}" r="4" fill="black" stroke="rgb(160,160,160)" stroke-width="3.0"/>
-'''
+        svg = '\n'
+        for radius, fill, stroke, stroke_width in self.layercfg.circles:
+            svg += f' <circle cx="{x}" cy="{y}" r="{radius}" fill="{fill}" stroke="{stroke}" stroke-width="{stroke_width}"/>\n'
+        return svg
 
     def svg(self, variant):
         index = self.index(variant)
         x, y = self.coordinates[index]
         return self.circle(x, y)
 
+    def draw(self, canvas_, variant):
+        x, y = self.coordinates[self.index(variant)]
+        for radius, fill, stroke, stroke_width in self.layercfg.circles:
+            fill, stroke, stroke_width = canvas.parse_style(fill=fill, stroke=stroke, stroke_width=stroke_width)
+            canvas_.circle(x, y, radius, fill, stroke, stroke_width)
+        return ''
+
 
     def write_svg(self):
 
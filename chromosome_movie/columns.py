@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# Columnar copy of the database for the render pipeline.  Each column is
+# written as its own .npy file, which can then be memory-mapped so that
+# frame generation gets array access without going through SQLite rows.
+#
+# The variant_population table is stored CSR-style: the populations for
+# population_counts_match_variant_id m are entries offsets[m]:offsets[m+1]
+# of the population_id and node_count arrays.
+#
+# The layers only read the population side (see PopulationIndex); each
+# frame's variant row already comes from Order.select().  The variant
+# columns are there for anything else that wants the table as arrays.
+#
+# Rerun the columns step after the database or order steps, since it's a
+# snapshot.  It records the size and modification time of the database it
+# was taken from, and PopulationIndex refuses to use a snapshot of a
+# database that has been written to since.
+
+import sys
+import os
+
+import sqlite3
+import numpy
+
+from . import connection
+
+class Columns():
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.folder = self.cfg.columns_path
+        self.arrays = {}
+
+    def write_npy(self):
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Taken before reading, and only written once everything else is,
+        # so that an interrupted or overlapping run doesn't look current.
+        database_key = self.database_key()
+        if self.key_path().exists():
+            self.key_path().unlink()
+
+        database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
+        cursor = database.cursor()
+
+        self.write_table(cursor, 'variant', 'id')
+        self.write_table(cursor, 'population', 'id')
+        self.write_variant_population(cursor)
+
+        database.close()
+
+        self.key_path().write_text(database_key, encoding='utf-8')
+
+    def key_path(self):
+        return self.folder/'database.key'
+
+    def database_key(self):
+        '''
+        Size and modification time of the database file and its WAL file,
+        if there is one, which change whenever anything writes to it.
+        '''
+        key = []
+        for path in (str(self.cfg.database_path), f'{self.cfg.database_path}-wal'):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                key.append(f'{os.path.basename(path)} {stat.st_size} {stat.st_mtime_ns}\n')
+        return ''.join(key)
+
+    def check(self):
+        'Raise unless the snapshot is complete and the database is unchanged since.'
+        if not self.key_path().exists():
+            raise Exception(f'No complete columns snapshot in {self.folder}.  Run "run.py columns", or set columnar_population_index = False.')
+        if self.key_path().read_text(encoding='utf-8') != self.database_key():
+            raise Exception(f'{self.cfg.database_path} has changed since the columns in {self.folder} were written.  Rerun "run.py columns", or set columnar_population_index = False.')
+
+    def write_table(self, cursor, table, key):
+
+        cursor.execute(f'PRAGMA table_info({table})')
+        columns = [(row[1], row[2].upper()) for row in cursor.fetchall()]
+
+        for name, declared_type in columns:
+            sys.stderr.write(f'Writing column {table}.{name}...\n')
+            sys.stderr.flush()
+            cursor.execute(f'SELECT {name} FROM {table} ORDER BY {key}')
+            values = [row[0] for row in cursor]
+            numpy.save(self.path(table, name), self.to_array(values, declared_type))
+
+    def to_array(self, values, declared_type):
+        if 'INT' in declared_type:
+            if None in values:
+                # NULLs become NaN, which means a float column.  This is
+                # mostly the order columns for variants which haven't been
+                # ordered yet.
+                return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+            return numpy.array(values, dtype=numpy.int64)
+        elif 'REAL' in declared_type:
+            return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+        else:
+            return numpy.array(['' if value is None else value for value in values], dtype=str)
+
+    def write_variant_population(self, cursor):
+
+        sys.stderr.write('Writing variant_population index...\n')
+        sys.stderr.flush()
+
+        cursor.execute('SELECT variant_id, population_id, node_count FROM variant_population ORDER BY variant_id, population_id')
+        rows = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 3)
+
+        cursor.execute('SELECT MAX(id) FROM variant')
+        max_id = cursor.fetchone()[0]
+        size = 0 if max_id is None else max_id + 1
+
+        offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows[:, 0], minlength=size), out=offsets[1:])
+
+        numpy.save(self.path('variant_population', 'offsets'), offsets)
+        numpy.save(self.path('variant_population', 'population_id'), rows[:, 1].copy())
+        numpy.save(self.path('variant_population', 'node_count'), rows[:, 2].copy())
+
+    def path(self, table, name):
+        return self.folder/f'{table}.{name}.npy'
+
+    def load(self, table, name):
+        key = (table, name)
+        if key not in self.arrays:
+            self.arrays[key] = numpy.load(self.path(table, name), mmap_mode='r')
+        return self.arrays[key]
+
+    def population(self, name):
+        'Population column, in population ID order.'
+        return self.load('population', name)
+
+    def population_counts(self, match_id):
+        '''
+        (population_ids, node_counts) for a
+        population_counts_match_variant_id, as views into the mapped files.
+        '''
+        offsets = self.load('variant_population', 'offsets')
+        start, end = offsets[match_id], offsets[match_id + 1]
+        return self.load('variant_population', 'population_id')[start:end], self.load('variant_population', 'node_count')[start:end]
+
+
+def population_index(cfg):
+    '''
+    Variant-to-population lookups for the layer classes: memory-mapped from
+    the columns step if config.columnar_population_index is set, otherwise
+    straight from SQLite.
+    '''
+    if cfg.columnar_population_index:
+        return PopulationIndex(cfg)
+    else:
+        return SQLPopulationIndex(cfg)
+
+
+class PopulationIndex():
+
+    '''
+    Population lookups by population_counts_match_variant_id, using the
+    memory-mapped CSR index written by Columns.write_npy().
+    '''
+
+    def __init__(self, cfg):
+        self.columns = Columns(cfg)
+        self.columns.check()
+        self.offsets = self.columns.load('variant_population', 'offsets')
+
+        # Population columns are in ID order, but IDs can have gaps.
+        ids = self.columns.population('id')
+        self.rows = numpy.full(ids.max() + 1, -1, dtype=numpy.int64)
+        self.rows[ids] = numpy.arange(len(ids))
+
+        self.longitude = self.columns.population('longitude')
+        self.latitude = self.columns.population('latitude')
+        self.node_count = self.columns.population('node_count')
+        self.source = self.columns.population('source')
+        self.name = self.columns.population('name')
+
+    def count(self, match_id):
+        return int(self.offsets[match_id + 1] - self.offsets[match_id])
+
+    def locations(self, match_id):
+        'List of (longitude, latitude, variant node count, population node count).'
+        population_ids, node_counts = self.columns.population_counts(match_id)
+        rows = self.rows[population_ids]
+        return list(zip(self.longitude[rows].tolist(), self.latitude[rows].tolist(), node_counts.tolist(), self.node_count[rows].tolist()))
+
+    def names(self, match_id):
+        'List of (source, name).'
+        population_ids, node_counts = self.columns.population_counts(match_id)
+        rows = self.rows[population_ids]
+        return list(zip(self.source[rows].tolist(), self.name[rows].tolist()))
+
+
+class SQLPopulationIndex():
+
+    '''
+    Same interface as PopulationIndex, querying the database each time.
+    '''
+
+    def __init__(self, cfg):
+        self.database = connection.readonly(cfg)
+        self.cursor = self.database.cursor()
+
+    def count(self, match_id):
+        self.cursor.execute('''
+            SELECT
+                COUNT(*)
+            FROM
+                variant_population
+            WHERE
+                variant_id = ?
+        ''', (match_id,))
+        return self.cursor.fetchone()[0]
+
+    def locations(self, match_id):
+        self.cursor.execute('''
+            SELECT
+                population.longitude,
+                population.latitude,
+                variant_population.node_count,
+                population.node_count
+            FROM
+                population
+            JOIN
+                variant_population
+            ON
+                population.id = variant_population.population_id
+            WHERE
+                variant_population.variant_id = ?
+        ''', (match_id,))
+        return self.cursor.fetchall()
+
+    def names(self, match_id):
+        self.cursor.execute('''
+            SELECT
+                population.source AS source, population.name AS name
+            FROM
+                variant_population
+            JOIN
+                population
+            ON
+                variant_population.population_id = population.id
+            WHERE
+                variant_population.variant_id = ?
+        ''', (match_id,))
+        return self.cursor.fetchall()
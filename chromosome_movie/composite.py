@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
+import sys
 import os
+import math
 import pathlib
 import sqlite3
 
-from . import chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, clef, text, legend, graph, drop_shadow, svg2png, order
+from . import chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, clef, text, legend, graph, drop_shadow, svg2png, rasterize, canvas, cache, sprites, order
 
 class Composite():
 
@@ -41,19 +43,25 @@ class Composite():
             self.layers[name] = getattr(self.cfg.layers, name)
             self.layers[name].obj = self.classes[name](self.cfg)
 
-    def translate(self, layer):
-        transforms = []
+    def offset(self, layer):
+        '''
+        (left, top, scale) for a layer, or None if it sits at the origin.
+        '''
+        left = 0
+        top = 0
+        scale = 1
         if hasattr(layer, 'center'):
             #print(f' center: {layer.center}')
             left = 0
             top = 0
+            # Without a width or height, the layer is a full frame
+            # centered at .center, same as in the movie step.
             if hasattr(layer, 'width'):
                 #print(f' width: {layer.width}')
                 left = layer.center[0] - layer.width / 2
                 #width = layer.width
             else:
-                raise Exception('.center without .width')
-            #    left = layer.center[0] - self.cfg.width / 2
+                left = layer.center[0] - self.cfg.width / 2
             #    width = self.cfg.width
             #print(f' left: {left}')
             if hasattr(layer, 'height'):
@@ -61,16 +69,26 @@ class Composite():
                 top = layer.center[1] - layer.height / 2
                 #height = layer.height
             else:
-                raise Exception('.center without .height')
-            #    top = layer.center[1] - self.cfg.height / 2
+                top = layer.center[1] - self.cfg.height / 2
             #    height = self.cfg.height
             #print(f' top: {top}')
             # Here we end up not using width and height, unlike the ffmpeg
             # layering.  Interesting.
+        if hasattr(layer, 'scale'):
+            scale = layer.scale
+        if left == 0 and top == 0 and scale == 1:
+            return None
+        return left, top, scale
+
+    def translate(self, layer):
+        transforms = []
+        offset = self.offset(layer)
+        if offset:
+            left, top, scale = offset
             if left != 0 or top != 0:
                 transforms.append(f'translate({left} {top})')
-        if hasattr(layer, 'scale') and layer.scale != 1:
-            transforms.append(f'scale({layer.scale} {layer.scale})')
+            if scale != 1:
+                transforms.append(f'scale({scale} {scale})')
         if transforms:
             text = ' '.join(transforms)
             svg = (f'<g transform="{text}">\n', '</g>\n')
@@ -79,6 +97,112 @@ class Composite():
         return svg
 
 
+def merge_rects(rects):
+    '''
+    Merge overlapping pixel rectangles until none overlap.
+    '''
+    merged = []
+    for rect in rects:
+        while True:
+            for num, other in enumerate(merged):
+                if canvas.intersects(rect, other):
+                    rect = canvas.union(rect, merged.pop(num))
+                    break
+            else:
+                break
+        merged.append(rect)
+    return merged
+
+
+def damage_rects(items, previous, width, height):
+    '''
+    The rectangles Foreground.draw() has to repaint: the old and new bounds
+    of every layer whose signature changed, clamped to the frame and merged.
+    items are (name, signature, bbox, recorder, sprite) and previous maps
+    name to the last frame's (signature, bbox).
+    '''
+    frame_rect = (0, 0, width, height)
+    damage = []
+    for name, signature, bbox, recorder, sprite in items:
+        previous_signature, previous_bbox = previous.get(name, (None, None))
+        if signature != previous_signature:
+            # Shapes and sprites can hang off the frame.
+            rect = canvas.intersection(canvas.union(bbox, previous_bbox), frame_rect)
+            if rect:
+                damage.append(rect)
+    return merge_rects(damage)
+
+
+def repaint(frame, items, damage):
+    'Clear each damage rectangle and paint every layer that overlaps it.'
+    for rect in damage:
+        frame.set_clip(rect)
+        frame.clear()
+        for name, signature, bbox, recorder, sprite in items:
+            if not canvas.intersects(bbox, rect):
+                continue
+            if sprite and recorder.svg_first:
+                frame.blit(sprite[2], sprite[0], sprite[1])
+            recorder.replay(frame)
+            if sprite and not recorder.svg_first:
+                frame.blit(sprite[2], sprite[0], sprite[1])
+    frame.set_clip()
+
+
+def check_damage(width=320, height=240, frames=60, seed=1234):
+    '''
+    Draw random layers of circles, rectangles and sprites, plenty of them
+    hanging off the edges, both with damage tracking and with a full repaint
+    every frame, and check the two come out the same.
+    '''
+    import random
+    import numpy
+    generator = random.Random(seed)
+
+    def shape_layer():
+        recorder = canvas.Recorder()
+        for _ in range(generator.randint(0, 4)):
+            x = generator.uniform(-60, width + 60)
+            y = generator.uniform(-60, height + 60)
+            colour = (generator.random(), generator.random(), generator.random(), generator.uniform(0.3, 1))
+            if generator.random() < 0.5:
+                recorder.circle(x, y, generator.uniform(1, 40), fill=colour, stroke=colour, stroke_width=2)
+            else:
+                recorder.rect(x, y, generator.uniform(1, 80), generator.uniform(1, 80), fill=colour)
+        return (tuple(recorder.ops), None), recorder.bbox, recorder, None
+
+    def sprite_layer(key):
+        sprite_width, sprite_height = generator.randint(1, 60), generator.randint(1, 60)
+        left = generator.randint(-sprite_width - 10, width + 10)
+        top = generator.randint(-sprite_height - 10, height + 10)
+        rgba = numpy.array([[[generator.randrange(256) for _ in range(3)] + [generator.randint(1, 255)]] * sprite_width] * sprite_height, dtype=numpy.uint8)
+        return ((), key), (left, top, left + sprite_width, top + sprite_height), canvas.Recorder(), (left, top, rgba, (left, top, left + sprite_width, top + sprite_height))
+
+    layers = {}
+    previous = {}
+    frame = canvas.Canvas(width, height)
+    repaint(frame, [], [(0, 0, width, height)])
+    worst = 0
+    for number in range(frames):
+        for name in range(8):
+            # Most layers stay put from one frame to the next.
+            if name not in layers or generator.random() < 0.3:
+                layers[name] = shape_layer() if name % 2 else sprite_layer((number, name))
+        items = [(name,) + layers[name] for name in range(8)]
+
+        repaint(frame, items, damage_rects(items, previous, width, height))
+        previous = {name: (signature, bbox) for name, signature, bbox, recorder, sprite in items}
+
+        full = canvas.Canvas(width, height)
+        repaint(full, items, [(0, 0, width, height)])
+        worst = max(worst, float(numpy.abs(frame.pixels - full.pixels).max()))
+
+    passed = worst < 1e-5
+    sys.stderr.write(f'Damage tracking {"matches" if passed else "does not match"} full repaints over {frames} frames (max difference {worst}).\n')
+    sys.stderr.flush()
+    return passed
+
+
 class Foreground(Composite):
 
     def __init__(self, cfg, layer_names=None):
@@ -89,6 +213,16 @@ class Foreground(Composite):
 
         self.order = order.Order(cfg)
 
+        self.cache = cache.FrameCache(cfg, self.layercfg) if self.cfg.frame_cache else None
+        self.sprites = sprites.SpriteCache(cfg)
+
+        # Damage tracking state for draw(): the retained frame, and each
+        # layer's (signature, pixel bounds) from the last frame drawn.
+        self.frame = None
+        self.previous = {}
+        self.frames_drawn = 0
+        self.pixels_touched = 0
+
     #def select(self):
     #    database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
     #    database.row_factory = sqlite3.Row
@@ -108,13 +242,15 @@ class Foreground(Composite):
 
         #background_path = os.path.relpath(self.cfg.layers.background.svg, self.cfg.layers.composite.svg.parent).replace('\\', '/')
         #for variant in self.select():
+        sidecar = svg2png.Sidecar(self.layercfg.png) if self.cfg.resume else None
+        if self.cache:
+            self.cache.open()
+
         for variant in self.order.select():
             # In theory we could unify the contents of this loop with the
             # almost-identical background function.  Let's wait on that,
             # though, in case they diverge.
-            svg = f'<svg viewBox="0 0 {self.cfg.width} {self.cfg.height}" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
-            if self.cfg.shadows:
-                svg += drop_shadow.filter
+            svg = self.svg_header()
             #svg += f' <image xlink:href="{background_path}" x="0" y="0" width="{self.cfg.width}" height="{self.cfg.height}"/>\n'
             for name in self.layer_names:
                 #print(f'layer: {name}')
@@ -129,15 +265,148 @@ class Foreground(Composite):
                 if translate:
                     svg += translate[1]
             svg += '</svg>\n'
+            if self.cache and not self.cache.add(self.index(variant), svg):
+                # Same as an earlier frame, or already in the cache.
+                continue
+            if sidecar and sidecar.current(self.png_path(variant), svg2png.digest(svg.encode('utf-8')), (self.cfg.width, self.cfg.height)):
+                # Already rendered from exactly this SVG.
+                continue
             with open(self.svg_path(variant), 'w', encoding='utf-8') as output:
                 output.write(svg)
 
+        if self.cache:
+            self.cache.close()
+
+    def svg_header(self):
+        svg = f'<svg viewBox="0 0 {self.cfg.width} {self.cfg.height}" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+        if self.cfg.shadows:
+            svg += drop_shadow.filter
+        return svg
+
+    def sprite(self, layer, contents):
+        '''
+        Rasterize one layer's SVG into an RGBA sprite covering the layer's
+        box (plus sprite_margin for shadows), returning (left, top, rgba,
+        bbox) with the frame pixel offset to blit it at and the frame pixel
+        rectangle it actually covers (None if it's blank).
+        '''
+        import numpy
+        left, top, scale = self.offset(layer) or (0, 0, 1)
+        # Same as offset(): no width or height means a full frame.
+        width = getattr(layer, 'width', self.cfg.width)
+        height = getattr(layer, 'height', self.cfg.height)
+        margin = self.cfg.sprite_margin
+        # Snap the sprite to whole pixels and shift the viewBox by the
+        # difference, so that it lands where the full-frame SVG would put it.
+        x = left - margin * scale
+        y = top - margin * scale
+        pixel_left, pixel_top = math.floor(x), math.floor(y)
+        pixel_width = math.ceil((width + 2 * margin) * scale + x - pixel_left)
+        pixel_height = math.ceil((height + 2 * margin) * scale + y - pixel_top)
+        view_x = -margin - (x - pixel_left) / scale
+        view_y = -margin - (y - pixel_top) / scale
+        svg = f'<svg viewBox="{view_x} {view_y} {pixel_width / scale} {pixel_height / scale}" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+        if self.cfg.shadows:
+            svg += drop_shadow.filter
+        svg += contents
+        svg += '</svg>\n'
+        rgba = rasterize.svg_to_rgba(self.cfg, svg, self.layercfg.svg, pixel_width, pixel_height)
+        rows = numpy.flatnonzero(rgba[..., 3].any(axis=1))
+        columns = numpy.flatnonzero(rgba[..., 3].any(axis=0))
+        if len(rows):
+            bbox = (pixel_left + int(columns[0]), pixel_top + int(rows[0]), pixel_left + int(columns[-1]) + 1, pixel_top + int(rows[-1]) + 1)
+        else:
+            bbox = None
+        return pixel_left, pixel_top, rgba, bbox
+
+    def draw(self, variant):
+        '''
+        Render one frame into a canvas.Canvas.  Layers with a draw() method
+        paint into it.  Everything else, plus whatever SVG those draw() calls
+        hand back, is rasterized per layer into sprites, which are cached by
+        content (see sprites.py) and blitted in layer order.
+
+        The canvas is kept from frame to frame.  Each layer's draw() calls
+        are recorded and its sprite noted, and only where a layer's output
+        differs from the last frame is the canvas cleared and every layer
+        overlapping that rectangle painted again.  The returned canvas is
+        overwritten by the next call.
+        '''
+        items = []
+        for name in self.layer_names:
+            layer = self.layers[name]
+            recorder = canvas.Recorder()
+            recorder.svg_first = getattr(layer.obj, 'draw_svg_first', False)
+            if hasattr(layer.obj, 'draw'):
+                recorder.transform(*(self.offset(layer) or (0, 0, 1)))
+                contents = layer.obj.draw(recorder, variant)
+            else:
+                contents = layer.obj.svg(variant)
+            sprite = None
+            key = None
+            if contents:
+                key = svg2png.digest(contents.encode('utf-8'))
+                sprite = self.sprites.get((name, key), lambda: self.sprite(layer, contents))
+            bbox = canvas.union(recorder.bbox, sprite[3] if sprite else None)
+            items.append((name, (tuple(recorder.ops), key), bbox, recorder, sprite))
+
+        if self.frame is None or not self.cfg.damage_tracking:
+            self.frame = canvas.Canvas(self.cfg.width, self.cfg.height)
+            damage = [(0, 0, self.cfg.width, self.cfg.height)]
+        else:
+            damage = damage_rects(items, self.previous, self.cfg.width, self.cfg.height)
+        self.previous = {name: (signature, bbox) for name, signature, bbox, recorder, sprite in items}
+
+        repaint(self.frame, items, damage)
+        self.pixels_touched += sum(canvas.area(rect) for rect in damage)
+        self.frames_drawn += 1
+        return self.frame
+
+    def report(self):
+        self.sprites.report()
+        if self.frames_drawn:
+            per_frame = self.pixels_touched / self.frames_drawn
+            sys.stderr.write(f'Damage: {per_frame:.0f} pixels touched per frame ({per_frame / (self.cfg.width * self.cfg.height):.1%} of the frame)\n')
+            sys.stderr.flush()
+
+    def advance(self, variant):
+        '''
+        Step the stateful layers (histogram windows, traces) past a frame
+        without rendering it, so a worker can skip frames that aren't its
+        own and still draw the rest correctly.
+        '''
+        for name in self.layer_names:
+            obj = self.layers[name].obj
+            if hasattr(obj, 'advance'):
+                obj.advance(variant)
+
+    def write_canvas_png(self):
+        '''
+        Straight to PNG via draw(), without writing SVG files.
+        '''
+
+        self.layercfg.png.parent.mkdir(parents=True, exist_ok=True)
+
+        for num, variant in enumerate(self.order.select()):
+            self.draw(variant).save(self.png_path(variant))
+            if (num + 1) % svg2png.chunk_size == 0:
+                sys.stderr.write(f'Drew {num+1} frames.\n')
+                sys.stderr.flush()
+        self.report()
+
     def write_png(self):
 
         self.layercfg.png.parent.mkdir(parents=True, exist_ok=True)
 
         #svg2png.svg2png(self.cfg, self.layercfg.svg, self.layercfg.png, self.select(), frame_convert=self.index)
-        svg2png.svg2png(self.cfg, self.layercfg.svg, self.layercfg.png, self.order.select(), frame_convert=self.index)
+        if self.cache:
+            rasterize.rasterize(self.cfg, self.layercfg.svg, self.layercfg.png, self.cache.pending(), finished=self.cache.store)
+            self.cache.link()
+        else:
+            rasterize.rasterize(self.cfg, self.layercfg.svg, self.layercfg.png, self.order.select(), frame_convert=self.index)
+
+    def check_png(self):
+        return rasterize.check(self.cfg, self.layercfg.svg, self.layercfg.png, self.order.select(), frame_convert=self.index)
 
     def index(self, variant):
         #return variant[self.order_key]
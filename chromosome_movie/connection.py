@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# One shared read-only database connection per process for the layer
+# objects.  Composite sets up a couple dozen layers, and they used to each
+# open their own connection with its own page cache; now they all get
+# cursors off the same one.
+#
+# The pool lives on the cfg (cfg.database_pool) so everything built from the
+# same config shares it.  Connections are keyed by process ID, since an
+# SQLite connection can't be carried across a fork: a forked render worker
+# just opens its own on first use.
+
+import os
+import sqlite3
+
+class Pool():
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.connections = {}
+
+    def connection(self):
+        pid = os.getpid()
+        if pid not in self.connections:
+            self.connections[pid] = self.connect()
+        return self.connections[pid]
+
+    def connect(self):
+        database = sqlite3.connect(
+            self.cfg.database_readonly_uri,
+            uri=True,
+            cached_statements=self.cfg.database_cached_statements,
+        )
+        database.row_factory = sqlite3.Row
+        # Negative cache_size is in KiB rather than pages.
+        database.execute(f'PRAGMA cache_size=-{int(self.cfg.database_read_cache_kib)}')
+        database.execute(f'PRAGMA mmap_size={int(self.cfg.database_mmap_size)}')
+        return database
+
+    def close(self):
+        connection = self.connections.pop(os.getpid(), None)
+        if connection:
+            connection.close()
+
+
+def readonly(cfg):
+    '''
+    The shared read-only connection for this process, with sqlite3.Row rows.
+    '''
+    if not hasattr(cfg, 'database_pool'):
+        cfg.database_pool = Pool(cfg)
+    return cfg.database_pool.connection()
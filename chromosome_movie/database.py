@@ -6,8 +6,10 @@
 
 import sys
 import collections
-import math
 import json
+import time
+import hashlib
+import multiprocessing
 
 import sqlite3
 import numpy
@@ -15,6 +17,125 @@ import numpy
 import tskit
 
 
+# Set just before the shard pool forks so that the workers inherit the loaded
+# treeseq and lookup arrays instead of having them pickled across.
+_shard_state = None
+
+def population_counts_hash(population_ids, node_counts):
+    '''
+    Stable 64-bit hash of a sorted population count vector, as a signed
+    integer so that SQLite can use it as an INTEGER PRIMARY KEY.
+    '''
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(numpy.asarray(population_ids, dtype='<i8').tobytes())
+    digest.update(numpy.asarray(node_counts, dtype='<i8').tobytes())
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def average_locations(offsets, longitudes, latitudes, weights=None):
+    '''
+    Great-circle average locations for many variants at once.
+
+    Variant i is entries offsets[i]:offsets[i+1] of longitudes, latitudes
+    and weights, which are per-population arrays in degrees.  Without
+    weights, every population counts equally.
+
+    Returns arrays of average longitude, average latitude and average
+    distance to average location, all in degrees.
+    '''
+    # Loosely based on:
+    # https://gis.stackexchange.com/a/7566
+    # ...but with a bunch of things reversed to give the right answers.
+
+    offsets = numpy.asarray(offsets)
+    starts = offsets[:-1]
+    counts = numpy.diff(offsets)
+
+    longitudes = numpy.radians(longitudes)
+    latitudes = numpy.radians(latitudes)
+    if weights is None:
+        weights = 1
+
+    cos_latitudes = numpy.cos(latitudes)
+    sin_latitudes = numpy.sin(latitudes)
+
+    x = numpy.add.reduceat(cos_latitudes * numpy.cos(longitudes) * weights, starts) / counts
+    y = numpy.add.reduceat(cos_latitudes * numpy.sin(longitudes) * weights, starts) / counts
+    z = numpy.add.reduceat(sin_latitudes * weights, starts) / counts
+
+    average_longitudes = numpy.arctan2(y, x)
+    average_latitudes = numpy.arctan2(z, (x**2 + y**2)**0.5)
+
+    # Spread each variant's average back over its populations.
+    each_longitude = numpy.repeat(average_longitudes, counts)
+    each_latitude = numpy.repeat(average_latitudes, counts)
+
+    distances = numpy.arccos(numpy.clip(
+        sin_latitudes * numpy.sin(each_latitude)
+        + cos_latitudes * numpy.cos(each_latitude)
+        * numpy.cos(numpy.absolute(longitudes - each_longitude)),
+        -1, 1)
+    )
+    average_distances = numpy.add.reduceat(distances, starts) / counts
+
+    return numpy.degrees(average_longitudes), numpy.degrees(average_latitudes), numpy.degrees(average_distances)
+
+
+def population_arrays(cursor, size=0):
+    '''
+    Load the population table into arrays indexed by population ID, so
+    that per-variant lookups are array indexing instead of dict lookups.
+    '''
+
+    cursor.execute('SELECT id, node_count, longitude, latitude, region FROM population')
+    rows = cursor.fetchall()
+
+    size = max([size] + [row[0] + 1 for row in rows])
+    node_count = numpy.zeros(size, dtype=numpy.int64)
+    longitude = numpy.zeros(size, dtype=numpy.float64)
+    latitude = numpy.zeros(size, dtype=numpy.float64)
+    # -1 marks populations that add_populations() didn't keep.
+    region = numpy.full(size, -1, dtype=numpy.int64)
+
+    regions = {}
+    for population_id, count, lon, lat, region_name in rows:
+        node_count[population_id] = count
+        longitude[population_id] = lon
+        latitude[population_id] = lat
+        region[population_id] = regions.setdefault(region_name, len(regions))
+
+    return {
+        'node_count': node_count,
+        'longitude': longitude,
+        'latitude': latitude,
+        'region': region,
+    }
+
+
+def update_from_rows(cursor, table, columns, rows, match='id'):
+    '''
+    Set columns in table from rows of (key, *values), where key matches
+    the match column.  Goes through a temporary table and a single
+    UPDATE ... FROM join instead of one UPDATE per row.
+    '''
+
+    temp = f'{table}_update'
+    cursor.execute(f'DROP TABLE IF EXISTS temp.{temp}')
+    cursor.execute(f'CREATE TEMP TABLE {temp} (key INTEGER PRIMARY KEY, {", ".join(columns)})')
+    cursor.executemany(f'INSERT INTO temp.{temp} VALUES ({", ".join("?" * (len(columns) + 1))})', rows)
+    assignments = ', '.join(f'{column}={temp}.{column}' for column in columns)
+    cursor.execute(f'UPDATE {table} SET {assignments} FROM temp.{temp} WHERE {table}.{match}={temp}.key')
+    cursor.execute(f'DROP TABLE temp.{temp}')
+
+
+def _shard_records(interval):
+    database, populations, samples = _shard_state
+    stats = collections.Counter()
+    fingerprints = []
+    records = list(database.variant_records(populations, samples, stats, *interval, fingerprints=fingerprints))
+    return records, stats, fingerprints
+
+
 class Database():
 
     def __init__(self, cfg):
@@ -38,24 +159,78 @@ class Database():
                     population_info = dict(zip(headers, values))
                     self.population_info[population_info['Population elastic ID']] = population_info
 
+    # Secondary indexes from create_indexes(), which a bulk load drops
+    # before loading and rebuilds afterwards.
+    index_names = (
+        'time_idx',
+        'region_count_idx',
+        'population_counts_match_variant_id_idx',
+        'variant_type_idx',
+        'chromosome_position_idx',
+        'average_location_idx',
+        'average_distance_to_average_location_idx',
+        'variant_id_idx',
+    )
+
+    def connect(self, bulk_load=None):
+        '''
+        bulk_load defaults to config.database_bulk_load.  refresh_db()
+        passes False, since a refresh that dies partway through has to be
+        able to roll back.
+        '''
+        if bulk_load is None:
+            bulk_load = self.cfg.database_bulk_load
+        database = sqlite3.connect(self.cfg.database_path)
+        if bulk_load:
+            # Trading crash safety for speed.  If a bulk load dies partway
+            # through, rerun it.
+            database.execute(f'PRAGMA journal_mode={self.cfg.database_journal_mode}')
+            database.execute('PRAGMA synchronous=OFF')
+        if self.cfg.database_bulk_load:
+            # The big cache is safe either way.  Negative cache_size is in
+            # KiB rather than pages.
+            database.execute(f'PRAGMA cache_size=-{self.cfg.database_cache_kib}')
+            database.execute('PRAGMA temp_store=MEMORY')
+        return database
+
     def write_db(self):
-        self.create_tables()
-        self.write_data()
-        self.create_indexes()
+        if self.cfg.database_bulk_load:
+            # One connection for the whole load.
+            self.cfg.database_path.parent.mkdir(parents=True, exist_ok=True)
+            database = self.connect()
+            self.create_tables(database)
+            self.drop_indexes(database)
+            self.write_data(database)
+            self.create_indexes(database)
+            database.close()
+        else:
+            self.create_tables()
+            self.write_data()
+            self.create_indexes()
+
 
+    def write_data(self, database=None):
 
-    def write_data(self):
+        self.add_chromosome(database)
+        self.add_populations(database)
+        self.add_variants(database)
 
-        self.add_chromosome()
-        self.add_populations()
-        self.add_variants()
 
+    def drop_indexes(self, database):
 
-    def create_tables(self):
+        cursor = database.cursor()
+        for name in self.index_names:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        database.commit()
+
+
+    def create_tables(self, database=None):
 
         self.cfg.database_path.parent.mkdir(parents=True, exist_ok=True)
 
-        database = sqlite3.connect(self.cfg.database_path)
+        own_database = database is None
+        if own_database:
+            database = self.connect()
         cursor = database.cursor()
 
         cursor.execute('''
@@ -119,15 +294,36 @@ class Database():
             );
         ''')
 
+        # Fingerprint of each site's treeseq data, so that refresh_db()
+        # only has to redo the sites which have changed.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS site (
+                position REAL PRIMARY KEY,
+                fingerprint INTEGER
+            );
+        ''')
+
+        # Lookup from population count pattern to the first variant which
+        # has it.  See add_variants().
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS population_counts (
+                hash INTEGER PRIMARY KEY,
+                variant_id INTEGER
+            );
+        ''')
+
         database.commit()
-        database.close()
+        if own_database:
+            database.close()
 
-    def create_indexes(self):
+    def create_indexes(self, database=None):
 
         sys.stderr.write('Creating indexes...\n')
         sys.stderr.flush()
 
-        database = sqlite3.connect(self.cfg.database_path)
+        own_database = database is None
+        if own_database:
+            database = self.connect()
         cursor = database.cursor()
 
         cursor.execute('''
@@ -165,10 +361,11 @@ class Database():
         #        ON variant (worldwide_frequency);
         #''')
 
-        #cursor.execute('''
-        #    CREATE INDEX IF NOT EXISTS chromosome_position_idx
-        #        ON variant (chromosome_position);
-        #''')
+        # Used by refresh_db() to find the variants at a site.
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS chromosome_position_idx
+                ON variant (chromosome_position);
+        ''')
 
         #cursor.execute('''
         #    CREATE INDEX IF NOT EXISTS average_longitude_idx
@@ -196,12 +393,15 @@ class Database():
         ''')
 
         database.commit()
-        database.close()
+        if own_database:
+            database.close()
 
 
-    def add_chromosome(self):
+    def add_chromosome(self, database=None):
 
-        database = sqlite3.connect(self.cfg.database_path)
+        own_database = database is None
+        if own_database:
+            database = self.connect()
         cursor = database.cursor()
 
         entry = (
@@ -233,11 +433,14 @@ class Database():
         #self.chromosome_id = cursor.lastrowid
 
         database.commit()
-        database.close()
+        if own_database:
+            database.close()
 
 
-    def add_populations(self):
-        database = sqlite3.connect(self.cfg.database_path)
+    def add_populations(self, database=None):
+        own_database = database is None
+        if own_database:
+            database = self.connect()
         cursor = database.cursor()
 
         # FIXME: This is a hack which is likely to break.  To figure out which
@@ -321,213 +524,580 @@ class Database():
             ''', entries)
 
         database.commit()
-        database.close()
+        if own_database:
+            database.close()
 
 
-    def average_location(self, local_frequencies):
-        # Loosely based on:
-        # https://gis.stackexchange.com/a/7566
-        # ...but with a bunch of things reversed to give the right answers.
+    def population_average_locations(self, populations, offsets, population_ids, node_counts):
+        '''
+        average_locations() for CSR population counts, with populations
+        from population_arrays().
+        '''
 
-        longitudes = numpy.radians(numpy.array([lf[0][0] for lf in local_frequencies]))
-        latitudes = numpy.radians(numpy.array([lf[0][1] for lf in local_frequencies]))
         if self.cfg.weighted_average_locations:
-            weights = numpy.array([lf[1] for lf in local_frequencies])
+            weights = node_counts / populations['node_count'][population_ids]
         else:
-            weights = 1
+            weights = None
 
-        x = numpy.average(numpy.cos(latitudes) * numpy.cos(longitudes) * weights)
-        y = numpy.average(numpy.cos(latitudes) * numpy.sin(longitudes) * weights)
-        z = numpy.average(numpy.sin(latitudes) * weights)
+        return average_locations(offsets, populations['longitude'][population_ids], populations['latitude'][population_ids], weights)
 
-        average_longitude = math.atan2(y, x)
-        average_latitude = math.atan2(z, (x**2 + y**2)**0.5)
 
-        average_distance_to_average_location = numpy.sum(numpy.arccos(numpy.clip(
-            numpy.sin(latitudes) * numpy.sin(average_latitude)
-            + numpy.cos(latitudes) * numpy.cos(average_latitude)
-            * numpy.cos(numpy.absolute(longitudes - average_longitude)),
-            -1, 1)
-        )) / len(local_frequencies)
+    def population_arrays(self, cursor):
+        return population_arrays(cursor, self.treeseq.num_populations)
 
-        return math.degrees(average_longitude), math.degrees(average_latitude), math.degrees(average_distance_to_average_location)
 
+    def sample_arrays(self):
+        '''
+        Population and individual for each sample, indexed the same way as
+        variant.genotypes.
+        '''
 
-    def add_variants(self):
+        nodes = self.treeseq.tables.nodes
+        samples = self.treeseq.samples()
+        return {
+            'population': nodes.population[samples].astype(numpy.int64),
+            'individual': nodes.individual[samples].astype(numpy.int64),
+            'node_time': nodes.time,
+        }
 
-        # Bit of an omnibus function, I guess?  Should it be broken up?
 
-        database = sqlite3.connect(self.cfg.database_path)
-        cursor = database.cursor()
+    def site_fingerprint(self, variant, node_time):
+        '''
+        Hash of everything about a site that goes into its variant rows, so
+        that refresh_db() can tell which sites have changed.
+        '''
+        site = variant.site
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(repr((
+            site.position,
+            site.ancestral_state,
+            variant.alleles,
+            [(mutation.derived_state, float(node_time[mutation.node])) for mutation in site.mutations],
+        )).encode('utf-8'))
+        digest.update(variant.genotypes.tobytes())
+        return int.from_bytes(digest.digest(), 'little', signed=True)
 
-        populations = {}
 
-        cursor.execute('SELECT id, source, name, node_count, longitude, latitude, region FROM population')
+    def variant_records(self, populations, samples, stats, left=0, right=None, fingerprints=None):
+        '''
+        Yield one record per usable allele, in treeseq order.  See
+        site_records().  If fingerprints is a list, (position, fingerprint)
+        is appended to it for every site, including sites with no usable
+        alleles.
+        '''
+
+        for variant in self.treeseq.variants(left=left, right=right):
+            if fingerprints is not None:
+                fingerprints.append((variant.site.position, self.site_fingerprint(variant, samples['node_time'])))
+            yield from self.site_records(variant, populations, samples, stats)
+
+
+    def site_records(self, variant, populations, samples, stats):
+        '''
+        Yield one record per usable allele at a site:
+
+            (population_ids, node_counts, entry)
+
+        ...where entry is the variant row minus the fields which depend on
+        where the record ends up in the database (id and
+        population_counts_match_variant_id) and the average location fields,
+        which are calculated later.
+        '''
+
+        sample_population = samples['population']
+        sample_individual = samples['individual']
+        node_time = samples['node_time']
+        population_region = populations['region']
+
+        genotypes = variant.genotypes
+        site = variant.site
+
+        for allele_index, allele in enumerate(variant.alleles):
+
+            if allele_index == 0 or not allele:
+                continue
+
+            stats['all'] += 1
+
+            carriers = numpy.flatnonzero(genotypes == allele_index)
+            carrier_individuals = sample_individual[carriers]
 
-        for row in cursor:
-            population_id, source, name, node_count, longitude, latitude, region = row
-            populations[population_id] = {
-                'source': source,
-                'name': name,
-                'node_count': node_count,
-                'longitude': longitude,
-                'latitude': latitude,
-                'location': (longitude, latitude),
-                'region': region,
-            }
+            if len(carriers) <= 1 or (carrier_individuals == carrier_individuals[0]).all():
+                stats['one individual'] += 1
+                continue
+
+            population_counts = numpy.bincount(sample_population[carriers], minlength=len(population_region))
+            population_ids = numpy.flatnonzero(population_counts)
+            node_counts = population_counts[population_ids]
+
+            # The oldest mutation to this allele gives the variant date.
+            # argmax() keeps the first of equally old mutations, the same
+            # as the stable reverse sort we used to do.
+            mutation_nodes = numpy.array([mutation.node for mutation in site.mutations if mutation.derived_state == allele])
+            oldest = self.treeseq.node(mutation_nodes[numpy.argmax(node_time[mutation_nodes])])
+            time = oldest.time
+            if oldest.metadata:
+                oldest_meta = json.loads(oldest.metadata)
+                time_mean = oldest_meta['mn']
+                time_variance = oldest_meta['vr']
+            else:
+                # FIXME: These are wrong, but what else are we going to do?
+                time_mean = time
+                time_variance = 0
+
+            entry = (
+                self.cfg.chromosome,
+                time,
+                time_mean,
+                time_variance,
+                len(carriers)/self.treeseq.num_samples,
+                site.ancestral_state,
+                allele,
+                site.position,
+                len(numpy.unique(population_region[population_ids])),
+            )
+
+            yield population_ids, node_counts, entry
+
+
+    def match_population_counts(self, cursor, variant_id, population_ids, node_counts, pending, population_entries):
+        '''
+        Return the ID of the first variant with these population counts.
+        If there isn't one, variant_id becomes it: its hash goes in pending
+        and its counts in population_entries, ready for write_variants().
+        '''
+
+        counts_hash = population_counts_hash(population_ids, node_counts)
+        match_id = pending.get(counts_hash)
+        if match_id is None:
+            cursor.execute('SELECT variant_id FROM population_counts WHERE hash=?', (counts_hash,))
+            row = cursor.fetchone()
+            if row:
+                match_id = row[0]
+            else:
+                match_id = variant_id
+                pending[counts_hash] = match_id
+                population_entries.extend((variant_id, int(population_id), int(node_count)) for population_id, node_count in zip(population_ids, node_counts))
+        return match_id
+
+
+    def variant_entries(self, records, populations):
+        '''
+        Turn (variant_id, match_id, population_ids, node_counts, entry)
+        records into full variant rows, calculating average locations for
+        the whole batch at once.
+        '''
+
+        if not records:
+            return []
+
+        offsets = numpy.zeros(len(records) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(record[2]) for record in records], out=offsets[1:])
+        population_ids = numpy.concatenate([record[2] for record in records])
+        node_counts = numpy.concatenate([record[3] for record in records])
+
+        longitudes, latitudes, distances = self.population_average_locations(populations, offsets, population_ids, node_counts)
+
+        return [
+            (variant_id,) + entry[:-1] + (
+                float(longitude),
+                float(latitude),
+                float(distance),
+                match_id,
+                entry[-1],
+            )
+            for (variant_id, match_id, population_ids, node_counts, entry), longitude, latitude, distance
+            in zip(records, longitudes, latitudes, distances)
+        ]
+
+
+    def add_variants(self, database=None):
+
+        own_database = database is None
+        if own_database:
+            database = self.connect()
+        cursor = database.cursor()
+
+        populations = self.population_arrays(cursor)
+        samples = self.sample_arrays()
 
         # Only record the first variant ID for which a given combination
         # of population counts occurs, and have the other variants refer back
         # to it.  This cuts down the number of images we have to create
         # by about half, which is significant given that converting all of
         # them is a 20-24 hour process on my machine.
-        # I'm guessing that this is the memory hog in this script.  This,
-        # or not committing the database until everything is done.
-        population_counts_seen = {}
+        # Patterns are stored by hash in the population_counts table rather
+        # than in memory, so that memory use doesn't grow with the number of
+        # distinct patterns.  Only the patterns first seen in the current
+        # chunk are kept in memory until the chunk is written.
+        cursor.execute('DELETE FROM population_counts')
+        cursor.execute('DELETE FROM site')
+        population_counts_pending = {}
+        population_counts_new = 0
 
-        num_all = 0
         num_used = 0
-        skipped = collections.Counter()
+        uncommitted = 0
+        stats = collections.Counter()
+        start_time = time.monotonic()
 
-        for vnum, variant in enumerate(self.treeseq.variants()):
-            for allele_index, allele in enumerate(variant.alleles):
+        chunk_records = []
+        population_entries = []
+        fingerprints = []
 
-                if allele_index == 0 or not allele:
-                    continue
+        if self.cfg.database_workers > 1:
+            records = self.sharded_records(populations, samples, stats, fingerprints)
+        else:
+            records = self.variant_records(populations, samples, stats, fingerprints=fingerprints)
 
-                if num_all % 1000 == 0:
-                    sys.stderr.write(f'Loading### {num_used}/{num_all}\n')
-                    sys.stderr.write(f'Skipped: {skipped}\n')
-                    sys.stderr.write(f'Population counts seen: {len(population_counts_seen)}\n')
-                    sys.stderr.flush()
+        for population_ids, node_counts, entry in records:
 
-                num_all += 1
+            if num_used % 1000 == 0:
+                sys.stderr.write(f'Loading### {num_used}/{stats["all"]}\n')
+                sys.stderr.write(f'Skipped: {stats["one individual"]}\n')
+                sys.stderr.write(f'Population counts seen: {population_counts_new}\n')
+                sys.stderr.flush()
 
-                sample_nodes = numpy.where(variant.genotypes == allele_index)[0]
-                full_nodes = [self.treeseq.node(node) for node in sample_nodes]
-                individuals = frozenset(node.individual for node in full_nodes)
+            match_id = self.match_population_counts(cursor, num_used, population_ids, node_counts, population_counts_pending, population_entries)
+            if match_id == num_used:
+                population_counts_new += 1
 
-                if len(sample_nodes) == 1:
-                    region_count = -1
-                elif len(individuals) == 1:
-                    region_count = -2
-                else:
-                    region_count = len(set(populations[node.population]['region'] for node in full_nodes))
-
-                if region_count < 1:
-                    skipped['one individual'] += 1
-                    continue
-
-                mutation_nodes = [self.treeseq.node(mutation.node) for mutation in variant.site.mutations if mutation.derived_state == allele]
-                mutation_nodes.sort(reverse=True, key=lambda node: node.time)
-                oldest = mutation_nodes[0]
-                time = oldest.time
-                if oldest.metadata:
-                    oldest_meta = json.loads(oldest.metadata)
-                    time_mean = oldest_meta['mn']
-                    time_variance = oldest_meta['vr']
+            chunk_records.append((num_used, match_id, population_ids, node_counts, entry))
+
+            num_used += 1
+
+            if len(chunk_records) >= self.cfg.database_chunk_size:
+                uncommitted += len(chunk_records)
+                self.write_variants(cursor, self.variant_entries(chunk_records, populations), population_entries, population_counts_pending)
+                self.write_sites(cursor, fingerprints)
+                chunk_records = []
+                population_entries = []
+                population_counts_pending = {}
+                # Cleared in place, since the record generator appends to it.
+                fingerprints.clear()
+                if uncommitted >= self.cfg.database_commit_rows:
+                    database.commit()
+                    uncommitted = 0
+
+        self.write_variants(cursor, self.variant_entries(chunk_records, populations), population_entries, population_counts_pending)
+        self.write_sites(cursor, fingerprints)
+
+        database.commit()
+        if own_database:
+            database.close()
+
+        elapsed = time.monotonic() - start_time
+        sys.stderr.write(f'Loaded### {num_used}/{stats["all"]}\n')
+        sys.stderr.write(f'Variant rows/sec: {num_used / max(elapsed, 1e-9):,.0f} ({elapsed:,.1f} seconds)\n')
+        sys.stderr.flush()
+
+
+    def refresh_db(self):
+        '''
+        Update an existing database in place to match the treeseq, only
+        recalculating variants at sites whose fingerprint has changed,
+        removing variants at sites which have gone, and writing out the
+        population_counts_match_variant_id values whose images need to be
+        re-rendered.
+
+        IDs of existing variants are kept.  New variants get IDs after the
+        current highest, and will need an order step before they appear in
+        a movie.
+        '''
+
+        self.cfg.database_path.parent.mkdir(parents=True, exist_ok=True)
+        # Journaled, unlike a bulk load: this is the only copy.
+        database = self.connect(bulk_load=False)
+        cursor = database.cursor()
+        self.create_tables(database)
+
+        cursor.execute('SELECT position, fingerprint FROM site')
+        stored = dict(cursor.fetchall())
+
+        cursor.execute('SELECT * FROM population ORDER BY id')
+        old_populations = cursor.fetchall()
+        self.add_chromosome(database)
+        self.add_populations(database)
+        cursor.execute('SELECT * FROM population ORDER BY id')
+        new_populations = cursor.fetchall()
+
+        if not stored or old_populations != new_populations:
+            # Every variant's frequencies and average location depend on
+            # the population table, so there's nothing to gain from
+            # going site by site.
+            sys.stderr.write('No site fingerprints stored, or the populations have changed, doing a full rebuild.\n')
+            sys.stderr.flush()
+            # Start from empty tables, so that variants and populations
+            # which have gone don't hang around.  write_db() clears
+            # population_counts and site itself.
+            for table in ('variant', 'variant_population', 'population'):
+                cursor.execute(f'DELETE FROM {table}')
+            database.commit()
+            database.close()
+            self.write_db()
+            # Every image is stale.
+            database = self.connect()
+            cursor = database.cursor()
+            cursor.execute('SELECT DISTINCT population_counts_match_variant_id FROM variant')
+            invalidated = {match_id for match_id, in cursor.fetchall()}
+            database.close()
+            self.write_invalidated(invalidated)
+            return
+
+        populations = self.population_arrays(cursor)
+        samples = self.sample_arrays()
+        stats = collections.Counter()
+
+        changed = {}
+        fingerprints = []
+        seen = set()
+        for variant in self.treeseq.variants():
+            position = variant.site.position
+            fingerprint = self.site_fingerprint(variant, samples['node_time'])
+            seen.add(position)
+            if stored.get(position) != fingerprint:
+                fingerprints.append((position, fingerprint))
+                changed[position] = list(self.site_records(variant, populations, samples, stats))
+        vanished = set(stored) - seen
+
+        sys.stderr.write(f'Sites changed: {len(changed)} vanished: {len(vanished)} unchanged: {len(seen) - len(changed)}\n')
+        sys.stderr.flush()
+
+        # Existing variants at the sites we're touching.
+        existing = {}
+        for position in list(changed) + list(vanished):
+            cursor.execute('SELECT id, derived_state, population_counts_match_variant_id FROM variant WHERE chromosome_position=?', (position,))
+            for variant_id, derived_state, match_id in cursor.fetchall():
+                existing[(position, derived_state)] = (variant_id, match_id)
+
+        cursor.execute('SELECT MAX(id) FROM variant')
+        next_id = (cursor.fetchone()[0] or -1) + 1
+
+        # Work out IDs for the new records, reusing the old ID when a
+        # site keeps the same derived allele.
+        new_records = []
+        new_hashes = {}
+        for position, records in changed.items():
+            for population_ids, node_counts, entry in records:
+                key = (position, entry[6])
+                if key in existing:
+                    variant_id = existing[key][0]
                 else:
-                    # FIXME: These are wrong, but what else are we going to do?
-                    time_mean = time
-                    time_variance = 0
-
-                population_counts = collections.Counter()
-                for node in full_nodes:
-                    population_counts[node.population] += 1
-                population_counts = frozenset(population_counts.items())
-
-                node_frequencies_in_populations = []
-                for population_id, node_count in population_counts:
-                    population = populations[population_id]
-                    node_frequencies_in_populations.append((population['location'], node_count/population['node_count']))
-
-                average_longitude, average_latitude, average_distance_to_average_location = self.average_location(node_frequencies_in_populations)
-
-                if population_counts not in population_counts_seen:
-                    population_counts_seen[population_counts] = num_used
-                    # FIXME: If a population count changes to 0, this won't
-                    # delete it from the database.
-                    entries = [(num_used, population_id, node_count, node_count) for population_id, node_count in population_counts]
-                    cursor.executemany('''
-                        INSERT INTO variant_population
-                            (
-                                variant_id,
-                                population_id,
-                                node_count
-                            )
-                        VALUES
-                            (?, ?, ?)
-                        ON CONFLICT
-                            (variant_id, population_id)
-                        DO UPDATE SET
-                            node_count=?
-                    ''', entries)
-
-                entry = (
-                    num_used,
-                    self.cfg.chromosome,
-                    oldest.time,
-                    oldest_meta['mn'],
-                    oldest_meta['vr'],
-                    len(sample_nodes)/self.treeseq.num_samples,
-                    variant.site.ancestral_state,
-                    allele,
-                    variant.site.position,
-                    average_longitude,
-                    average_latitude,
-                    average_distance_to_average_location,
-                    population_counts_seen[population_counts],
-                    region_count
-                )
+                    variant_id = next_id
+                    next_id += 1
+                new_records.append((variant_id, population_ids, node_counts, entry))
+                new_hashes[variant_id] = population_counts_hash(population_ids, node_counts)
+        rewritten = {variant_id for variant_id, match_id in existing.values()}
+        removed = rewritten - set(new_hashes)
+
+        invalidated = set()
+
+        # Any rewritten variant which held a population count pattern for
+        # other variants has to hand it on, unless it still has the same
+        # pattern.
+        for variant_id, match_id in existing.values():
+            if variant_id != match_id:
+                continue
+            cursor.execute('SELECT hash FROM population_counts WHERE variant_id=?', (variant_id,))
+            row = cursor.fetchone()
+            old_hash = row[0] if row else None
+            if new_hashes.get(variant_id) == old_hash:
+                continue
+            invalidated.update(self.vacate_population_counts(cursor, variant_id, old_hash, rewritten))
+
+        if removed:
+            cursor.executemany('DELETE FROM variant WHERE id=?', [(variant_id,) for variant_id in removed])
 
-                # FIXME: if a variant is deleted, this won't remove it.
-                cursor.execute('''
-                    INSERT INTO variant
-                        (
-                            id,
-                            chromosome,
-                            time,
-                            time_mean,
-                            time_variance,
-                            worldwide_frequency,
-                            parent_state,
-                            derived_state,
-                            chromosome_position,
-                            average_longitude,
-                            average_latitude,
-                            average_distance_to_average_location,
-                            population_counts_match_variant_id,
-                            region_count
-                        )
-                    VALUES
-                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT
-                        (id)
-                    DO UPDATE SET
-                            chromosome=?,
-                            time=?,
-                            time_mean=?,
-                            time_variance=?,
-                            worldwide_frequency=?,
-                            parent_state=?,
-                            derived_state=?,
-                            chromosome_position=?,
-                            average_longitude=?,
-                            average_latitude=?,
-                            average_distance_to_average_location=?,
-                            population_counts_match_variant_id=?,
-                            region_count=?
-                    ''', entry + entry[1:])
-
-                num_used += 1
+        population_counts_pending = {}
+        population_entries = []
+        chunk_records = []
+        for variant_id, population_ids, node_counts, entry in new_records:
+            match_id = self.match_population_counts(cursor, variant_id, population_ids, node_counts, population_counts_pending, population_entries)
+            if match_id == variant_id and population_counts_pending.get(new_hashes[variant_id]) == variant_id:
+                invalidated.add(variant_id)
+            chunk_records.append((variant_id, match_id, population_ids, node_counts, entry))
+        self.write_variants(cursor, self.variant_entries(chunk_records, populations), population_entries, population_counts_pending)
+
+        cursor.executemany('DELETE FROM site WHERE position=?', [(position,) for position in vanished])
+        self.write_sites(cursor, fingerprints)
 
         database.commit()
         database.close()
 
-        sys.stderr.write(f'Loaded### {num_used}/{num_all}\n')
+        sys.stderr.write(f'Variants rewritten: {len(new_records)} removed: {len(removed)}\n')
+        sys.stderr.flush()
+        self.write_invalidated(invalidated)
+
+
+    def write_invalidated(self, invalidated):
+        '''
+        Replace database_invalidated_path with the
+        population_counts_match_variant_id values whose images are stale.
+        '''
+
+        self.cfg.database_invalidated_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cfg.database_invalidated_path, 'w') as output:
+            for match_id in sorted(invalidated):
+                output.write(f'{match_id}\n')
+
+        sys.stderr.write(f'Invalidated population count images: {len(invalidated)} (see {self.cfg.database_invalidated_path})\n')
         sys.stderr.flush()
 
 
+    def vacate_population_counts(self, cursor, variant_id, old_hash, rewritten):
+        '''
+        Hand variant_id's population count pattern on to the lowest-ID
+        variant which still refers to it and isn't being rewritten, or
+        delete the pattern if nobody is left.  Returns the
+        population_counts_match_variant_id values whose images are affected.
+        '''
+
+        placeholders = ','.join('?' * len(rewritten))
+        cursor.execute(f'''
+            SELECT
+                MIN(id)
+            FROM
+                variant
+            WHERE
+                population_counts_match_variant_id=?
+                AND id NOT IN ({placeholders})
+        ''', (variant_id, *rewritten))
+        heir = cursor.fetchone()[0]
+
+        if heir is None:
+            cursor.execute('DELETE FROM variant_population WHERE variant_id=?', (variant_id,))
+            cursor.execute('DELETE FROM population_counts WHERE variant_id=?', (variant_id,))
+            return {variant_id}
+
+        cursor.execute('UPDATE variant_population SET variant_id=? WHERE variant_id=?', (heir, variant_id))
+        cursor.execute('UPDATE variant SET population_counts_match_variant_id=? WHERE population_counts_match_variant_id=?', (heir, variant_id))
+        cursor.execute('UPDATE population_counts SET variant_id=? WHERE hash=?', (heir, old_hash))
+        return {variant_id, heir}
+
+
+    def write_sites(self, cursor, fingerprints):
+
+        cursor.executemany('''
+            INSERT INTO site
+                (position, fingerprint)
+            VALUES
+                (?, ?)
+            ON CONFLICT
+                (position)
+            DO UPDATE SET
+                fingerprint=excluded.fingerprint
+        ''', fingerprints)
+
+
+    def shard_intervals(self, count):
+        '''
+        Split the sequence into up to count [left, right) intervals with
+        roughly equal numbers of sites.
+        '''
+
+        positions = self.treeseq.tables.sites.position
+        starts = sorted(set(len(positions) * i // count for i in range(count)))
+        lefts = [0] + [float(positions[start]) for start in starts[1:]]
+        rights = lefts[1:] + [self.treeseq.sequence_length]
+        return list(zip(lefts, rights))
+
+
+    def sharded_records(self, populations, samples, stats, fingerprints):
+        '''
+        Same records as variant_records(), but calculated by a pool of
+        database_workers processes over site intervals.  Shards come back in
+        sequence order, so ID assignment and population count matching
+        happen in the same order as a single-process run.
+        '''
+
+        global _shard_state
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            sys.stderr.write('No fork() on this platform, loading variants in one process.\n')
+            sys.stderr.flush()
+            yield from self.variant_records(populations, samples, stats, fingerprints=fingerprints)
+            return
+
+        # A few shards per worker keeps everybody busy when some parts of
+        # the chromosome are denser than others.
+        intervals = self.shard_intervals(self.cfg.database_workers * 4)
+
+        _shard_state = (self, populations, samples)
+        try:
+            with multiprocessing.get_context('fork').Pool(self.cfg.database_workers) as pool:
+                for num, (records, shard_stats, shard_fingerprints) in enumerate(pool.imap(_shard_records, intervals)):
+                    sys.stderr.write(f'Merging shard {num+1}/{len(intervals)}\n')
+                    sys.stderr.flush()
+                    stats.update(shard_stats)
+                    fingerprints.extend(shard_fingerprints)
+                    yield from records
+        finally:
+            _shard_state = None
+
+
+    def write_variants(self, cursor, variant_entries, population_entries, population_counts_pending):
+
+        cursor.executemany('''
+            INSERT OR IGNORE INTO population_counts
+                (hash, variant_id)
+            VALUES
+                (?, ?)
+        ''', population_counts_pending.items())
+
+        cursor.executemany('''
+            INSERT INTO variant_population
+                (
+                    variant_id,
+                    population_id,
+                    node_count
+                )
+            VALUES
+                (?, ?, ?)
+            ON CONFLICT
+                (variant_id, population_id)
+            DO UPDATE SET
+                node_count=excluded.node_count
+        ''', population_entries)
+
+        # FIXME: if a variant is deleted, this won't remove it.
+        cursor.executemany('''
+            INSERT INTO variant
+                (
+                    id,
+                    chromosome,
+                    time,
+                    time_mean,
+                    time_variance,
+                    worldwide_frequency,
+                    parent_state,
+                    derived_state,
+                    chromosome_position,
+                    average_longitude,
+                    average_latitude,
+                    average_distance_to_average_location,
+                    population_counts_match_variant_id,
+                    region_count
+                )
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT
+                (id)
+            DO UPDATE SET
+                chromosome=excluded.chromosome,
+                time=excluded.time,
+                time_mean=excluded.time_mean,
+                time_variance=excluded.time_variance,
+                worldwide_frequency=excluded.worldwide_frequency,
+                parent_state=excluded.parent_state,
+                derived_state=excluded.derived_state,
+                chromosome_position=excluded.chromosome_position,
+                average_longitude=excluded.average_longitude,
+                average_latitude=excluded.average_latitude,
+                average_distance_to_average_location=excluded.average_distance_to_average_location,
+                population_counts_match_variant_id=excluded.population_counts_match_variant_id,
+                region_count=excluded.region_count
+        ''', variant_entries)
+
+
     def get_location(self, population, individual, notfound=set()):
         if any(individual.location):
             # Not sure why all the treeseqs don't store the location
@@ -1,9 +1,11 @@
 import collections
 import math
-import sqlite3
 
 from . import svg2png
 from . import drop_shadow
+from . import columns
+from . import connection
+from . import canvas
 
 class Graph():
 
@@ -14,8 +16,8 @@ class Graph():
         self.window = collections.deque(maxlen=self.layercfg.deque_length)
         self.frequencies = collections.Counter()
 
-        self.database = sqlite3.connect(cfg.database_readonly_uri, uri=True)
-        self.database.row_factory = sqlite3.Row
+        self.database = connection.readonly(cfg)
+        self.population_index = columns.population_index(cfg)
 
     def write_svg(self, path, contents):
         svg = f'<svg viewBox="0 0 {self.layercfg.width} {self.layercfg.height}" xmlns="http://www.w3.org/2000/svg">\n'
@@ -39,6 +41,10 @@ class Graph():
 
 class PopulationHistogram(Graph):
 
+    # svg() puts the scale labels under the bars, so draw() hands them back
+    # to go under what it paints.
+    draw_svg_first = True
+
     def __init__(self, cfg):
         self.layercfg = cfg.layers.population_histogram
         super().__init__(cfg)
@@ -60,15 +66,8 @@ class PopulationHistogram(Graph):
         # Unfortunately, I don't know how to do that.
         return 58 * math.asinh(proportion*33)
 
-    def svg(self, variant):
-
+    def labels(self):
         svg = ''
-
-        if variant[self.order_key] < self.cfg.layers.legend_population_histogram.start_order:
-            return svg
-
-        shadow = drop_shadow.magenta_style if self.cfg.shadows else ''
-
         # TODO: Should this be part of the legend?  This should probably
         # be part of the legend.  We'd just have to duplicate or import
         # the scale function over there.
@@ -77,34 +76,63 @@ class PopulationHistogram(Graph):
                 y = self.layercfg.height - self.scale(proportion)
                 # Not doing shadows since the text is so small.
                 svg += f'<text text-anchor="{anchor}" dominant-baseline="middle" x="{x}" dx="{dx}" y="{y}" font-size="{self.layercfg.font_size}" style="{self.layercfg.scale_style}">{proportion:.0%}</text>'
+        return svg
 
-        cursor = self.database.cursor()
-        cursor.execute('''
-            SELECT
-                COUNT(*)
-            FROM
-                variant_population
-            WHERE
-                variant_id = ?
-        ''', (variant['population_counts_match_variant_id'],))
-
-        count = cursor.fetchone()[0]
+    def advance(self, variant):
+        'Add this variant to the window without drawing anything.'
+        if variant[self.order_key] < self.cfg.layers.legend_population_histogram.start_order:
+            return
+        count = self.population_index.count(variant['population_counts_match_variant_id'])
         if len(self.window) == self.layercfg.deque_length:
             popped_count = self.window.popleft()
             self.frequencies[popped_count] -= 1
         self.frequencies[count] += 1
         self.window.append(count)
 
+    def bars(self, variant):
+        '''
+        Add this variant to the window and return (x, y, width, height) for
+        each bar.
+        '''
+        self.advance(variant)
+
+        bars = []
         for count, frequency in self.frequencies.items():
             x = self.layercfg.bar_width * count
             #height = self.layercfg.bar_height * frequency
             proportion = frequency / self.layercfg.deque_length
             height = self.scale(proportion)
             y = self.layercfg.height - height
-            svg += f'<rect x="{x}" y="{y}" width="{self.layercfg.bar_width}" height="{height}" style="{self.layercfg.style}{shadow}"/>\n'
+            bars.append((x, y, self.layercfg.bar_width, height))
+        return bars
+
+    def svg(self, variant):
+
+        svg = ''
+
+        if variant[self.order_key] < self.cfg.layers.legend_population_histogram.start_order:
+            return svg
+
+        shadow = drop_shadow.magenta_style if self.cfg.shadows else ''
+
+        svg += self.labels()
+
+        for x, y, width, height in self.bars(variant):
+            svg += f'<rect x="{x}" y="{y}" width="{width}" height="{height}" style="{self.layercfg.style}{shadow}"/>\n'
 
         return svg
 
+    def draw(self, canvas_, variant):
+        # The canvas can't do the drop shadow filter, so leave it to SVG.
+        if self.cfg.shadows:
+            return self.svg(variant)
+        if variant[self.order_key] < self.cfg.layers.legend_population_histogram.start_order:
+            return ''
+        fill, stroke, stroke_width = canvas.parse_style(self.layercfg.style)
+        for x, y, width, height in self.bars(variant):
+            canvas_.rect(x, y, width, height, fill, stroke, stroke_width)
+        return self.labels()
+
     def write_svg(self):
 
         self.layercfg.svg.parent.mkdir(parents=True, exist_ok=True)
@@ -115,6 +143,10 @@ class PopulationHistogram(Graph):
 
 class VariantHistogram(Graph):
 
+    # svg() puts the scale labels under the bars, so draw() hands them back
+    # to go under what it paints.
+    draw_svg_first = True
+
     def __init__(self, cfg):
         self.layercfg = cfg.layers.variant_histogram
         super().__init__(cfg)
@@ -130,10 +162,8 @@ class VariantHistogram(Graph):
     def scale(self, proportion):
         return self.layercfg.bar_width * proportion
 
-    def svg(self, variant):
-
+    def labels(self):
         svg = ''
-
         # TODO: Should this be part of the legend?  This should probably
         # be part of the legend.  We'd just have to duplicate or import
         # the scale function over there.
@@ -142,8 +172,10 @@ class VariantHistogram(Graph):
             y = 0
             # Not doing shadows since the text is so small.
             svg += f'<text text-anchor="middle" dominant-baseline="middle" x="{x}" y="{y}" dy="-0.6em" font-size="{self.layercfg.font_size}" style="{self.layercfg.scale_style}">{proportion:.0%}</text>'
+        return svg
 
-
+    def advance(self, variant):
+        'Add this variant to the window without drawing anything.'
         if len(self.window) == self.layercfg.deque_length:
             popped_state = self.window.popleft()
             self.frequencies[popped_state] -= 1
@@ -151,14 +183,36 @@ class VariantHistogram(Graph):
         self.frequencies[state] += 1
         self.window.append(state)
 
+    def bars(self, variant):
+        '''
+        Add this variant to the window and return (x, y, width, height) for
+        each bar.
+        '''
+        self.advance(variant)
+
+        bars = []
         for state, frequency in self.frequencies.items():
             width = self.scale(frequency / self.layercfg.deque_length)
             x = self.layercfg.width - width
             y = self.layercfg.bar_height * self.cfg.audio_notes[state]['index']
-            svg += f'<rect x="{x}" y="{y}" width="{width}" height="{self.layercfg.bar_height}" style="{self.layercfg.style}"/>\n'
+            bars.append((x, y, width, self.layercfg.bar_height))
+        return bars
+
+    def svg(self, variant):
+
+        svg = self.labels()
+
+        for x, y, width, height in self.bars(variant):
+            svg += f'<rect x="{x}" y="{y}" width="{width}" height="{height}" style="{self.layercfg.style}"/>\n'
 
         return svg
 
+    def draw(self, canvas_, variant):
+        fill, stroke, stroke_width = canvas.parse_style(self.layercfg.style)
+        for x, y, width, height in self.bars(variant):
+            canvas_.rect(x, y, width, height, fill, stroke, stroke_width)
+        return self.labels()
+
     def write_svg(self):
 
         self.layercfg.svg.parent.mkdir(parents=True, exist_ok=True)
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
-import sqlite3
 from xml.sax import saxutils
 
 from . import svg2png
 from . import drop_shadow
 from . import chromosome_position
+from . import connection
 
 
 class Legend():
@@ -191,8 +191,7 @@ class PopulationHistogram(Legend):
         super().__init__(cfg)
         self.layercfg = self.cfg.layers.legend_population_histogram
 
-        database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        cursor = database.cursor()
+        cursor = connection.readonly(self.cfg).cursor()
         cursor.execute('SELECT COUNT(*) FROM population')
         self.population_count = cursor.fetchone()[0]
 
@@ -2,10 +2,12 @@
 
 import collections
 import math
-import sqlite3
 
 from . import projections
 from . import svg2png
+from . import columns
+from . import connection
+from . import canvas
 
 # The SVG->PNG conversions from this script are the slowest part of the
 # whole process.  I tried to speed things up by putting all the dots
@@ -24,9 +26,9 @@ class Locations():
 
         self.projection = projections.get_projection(self.cfg.map_projection, self.cfg.map_rotation)
 
-        self.database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        self.database.row_factory = sqlite3.Row
+        self.database = connection.readonly(self.cfg)
         self.location_cursor = self.database.cursor()
+        self.population_index = columns.population_index(self.cfg)
 
         self.order_key = f'order_{self.cfg.order}'
 
@@ -64,11 +66,10 @@ class Locations():
             output.write(svg)
 
 
-    def circles(self, locations):
-
-        contents = ''
-
-        # Add location circles.
+    def circle_specs(self, locations):
+        '''
+        (center, radius, style) for each location circle.
+        '''
         #for longitude, latitude, local_frequency in locations:
         for longitude, latitude, variant_node_count, total_node_count in locations:
             if hasattr(self.layercfg, 'shrink_below_sample_count') and total_node_count < self.layercfg.shrink_below_sample_count:
@@ -82,11 +83,26 @@ class Locations():
 
             center = self.location_on_image(longitude, latitude)
 
+            yield center, radius, style
 
+    def circles(self, locations):
+
+        contents = ''
+
+        # Add location circles.
+        for center, radius, style in self.circle_specs(locations):
             contents += f'<circle cx="{center.x}" cy="{center.y}" r="{radius}" stroke-width="{self.layercfg.stroke_width}" style="{style}"/>\n'
 
         return contents
 
+    def draw_circles(self, canvas_, locations):
+        paints = {}
+        for center, radius, style in self.circle_specs(locations):
+            if style not in paints:
+                paints[style] = canvas.parse_style(style, stroke_width=self.layercfg.stroke_width)
+            fill, stroke, stroke_width = paints[style]
+            canvas_.circle(center.x, center.y, radius, fill, stroke, stroke_width)
+
     def angle(self, point, center):
         return math.degrees(math.atan2(point.y - center.y, point.x - center.x))
 
@@ -105,20 +121,8 @@ class Locations():
     def trace_locations(self, variant):
         if variant[self.order_key] >= self.cfg.layers.traces.start_order:
             #self.location_cursor.execute('SELECT longitude, latitude FROM variant_location WHERE variant_id=?', (variant['local_counts_match_variant_id'],))
-            self.location_cursor.execute('''
-                SELECT
-                    population.longitude AS longitude,
-                    population.latitude AS latitude
-                FROM
-                    population
-                JOIN
-                    variant_population
-                ON
-                    population.id = variant_population.population_id
-                WHERE
-                    variant_population.variant_id = ?
-            ''', (variant['population_counts_match_variant_id'],))
-            locations = list(self.location_cursor)
+            # (longitude, latitude) pairs.
+            locations = [location[:2] for location in self.population_index.locations(variant['population_counts_match_variant_id'])]
             #if len(locations) == 2:
             #    return locations
             return locations
@@ -140,8 +144,8 @@ class Locations():
             average_longitude = variant['average_longitude']
             average_latitude = variant['average_latitude']
         if self.cfg.layers.traces.prefer_pacific:
-            start_angle = locations[0]['longitude']
-            end_angle = locations[1]['longitude']
+            start_angle = locations[0][0]
+            end_angle = locations[1][0]
             start_new_world = 191 < (start_angle % 360) < 330
             end_new_world = 191 < (end_angle % 360) < 330
             if start_new_world != end_new_world:
@@ -170,23 +174,14 @@ class LocalFrequencies(Locations):
 
     def svg(self, variant):
         #self.location_cursor.execute('SELECT longitude, latitude, local_frequency FROM variant_location WHERE variant_id=?', (variant['local_counts_match_variant_id'],))
-        self.location_cursor.execute('''
-            SELECT
-                population.longitude,
-                population.latitude,
-                variant_population.node_count,
-                population.node_count
-            FROM
-                population
-            JOIN
-                variant_population
-            ON
-                population.id = variant_population.population_id
-            WHERE variant_population.variant_id = ?
-        ''', (variant['population_counts_match_variant_id'],))
-        locations = self.location_cursor.fetchall()
+        locations = self.population_index.locations(variant['population_counts_match_variant_id'])
         return self.circles(locations)
 
+    def draw(self, canvas_, variant):
+        locations = self.population_index.locations(variant['population_counts_match_variant_id'])
+        self.draw_circles(canvas_, locations)
+        return ''
+
     def write_svg(self):
 
         self.layercfg.svg.parent.mkdir(parents=True, exist_ok=True)
@@ -281,9 +276,9 @@ class Traces(Locations):
 
     def trace(self, variant, locations):
         average_longitude, average_latitude = self.pacific_flip(variant, locations)
-        start = self.location_on_image(locations[0]['longitude'], locations[0]['latitude'])
+        start = self.location_on_image(locations[0][0], locations[0][1])
         middle = self.location_on_image(average_longitude, average_latitude)
-        end = self.location_on_image(locations[1]['longitude'], locations[1]['latitude'])
+        end = self.location_on_image(locations[1][0], locations[1][1])
 
         return self.threepoint(start, middle, end)
 
@@ -296,11 +291,7 @@ class Traces(Locations):
         cursor.execute(sql, self.layercfg.start_order)
         return cursor
 
-    def svg(self, variant):
-        # Note that this function only gives good results for repeated calls
-        # if the calls are in the desired order, because it accumulates
-        # traces up to deque_length.
-
+    def advance(self, variant):
         locations = self.trace_locations(variant)
         if locations:
             # self.contents is a deque, so old entries will roll off when
@@ -309,6 +300,13 @@ class Traces(Locations):
             for snum, start in enumerate(locations[:-1]):
                 for end in locations[snum+1:]:
                     self.contents.append(self.trace(variant, (start, end)))
+
+    def svg(self, variant):
+        # Note that this function only gives good results for repeated calls
+        # if the calls are in the desired order, because it accumulates
+        # traces up to deque_length.
+
+        self.advance(variant)
         return '\n'.join(self.contents) + '\n'
 
         ## TODO: Make "on" time a config variable.
@@ -390,14 +388,20 @@ class AverageLocation(Locations):
         # allowing us to put the full index into 8 digits.
         return int((variant['average_longitude']%360)*10)*10000 + int((variant['average_latitude']%360))
 
-    def svg(self, variant):
+    def location(self, variant):
         locations = self.trace_locations(variant)
         if locations:
             average_longitude, average_latitude = self.pacific_flip(variant, locations)
         else:
             average_longitude, average_latitude = variant['average_longitude'], variant['average_latitude']
-        location = (average_longitude, average_latitude, 1, 1)
-        return self.circles([location])
+        return (average_longitude, average_latitude, 1, 1)
+
+    def svg(self, variant):
+        return self.circles([self.location(variant)])
+
+    def draw(self, canvas_, variant):
+        self.draw_circles(canvas_, [self.location(variant)])
+        return ''
 
 
     def write_svg(self):
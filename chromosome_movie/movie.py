@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import subprocess
 
 import sqlite3
 
-from . import chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, clef, text, audio, legend, graph, composite
+from . import chromosome_map, chromosome_position, world_map, locations, worldwide_frequency, clef, text, audio, legend, graph, composite, stream, cache
 
 class Movie():
 
@@ -437,3 +438,196 @@ class Movie():
         else:
             subprocess.call(ffmpeg_command)
 
+
+    def write_stream_mp4(self):
+        '''
+        Like write_bg_fg_mp4, but the foreground frames are drawn by
+        stream.frames() and piped into ffmpeg as raw RGBA instead of going
+        through PNG files.  Audio comes in on its own pipe, since stdin is
+        taken by the video, or from the WAV file where there's no pass_fds.
+        '''
+
+        self.cfg.movie_mp4.parent.mkdir(parents=True, exist_ok=True)
+
+        timidity_command = [
+            self.cfg.timidity,
+            str(self.cfg.audio_midi),
+            '-s', str(self.cfg.audio_samplerate),
+            '-Or1slS', # 16-bit signed linear PCM stereo
+            '-o', '-', # Pipe to stdout.
+        ]
+
+        ffmpeg_command = [
+            self.cfg.ffmpeg,
+            '-y',
+            '-threads', '0',
+            '-f', 'image2',
+            '-i', str(self.cfg.layers.background.png),
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgba',
+            '-s', f'{self.cfg.width}x{self.cfg.height}',
+            '-r', str(self.cfg.video_framerate),
+            '-i', '-', # Frames from stdin.
+        ]
+
+        # Passing ffmpeg a second pipe needs POSIX; elsewhere, write the
+        # WAV that audio_pipe would otherwise have saved us.
+        audio_pipe = self.cfg.audio_pipe and os.name == 'posix'
+        if self.cfg.audio_pipe and not audio_pipe:
+            self.cfg.audio_wav.parent.mkdir(parents=True, exist_ok=True)
+            subprocess.run(audio.Audio(self.cfg).wav_command(), check=True)
+
+        pass_fds = ()
+        timidity = None
+        if audio_pipe:
+            timidity = subprocess.Popen(timidity_command, stdout=subprocess.PIPE)
+            audio_fd = timidity.stdout.fileno()
+            pass_fds = (audio_fd,)
+            ffmpeg_command.extend([
+                '-f', 's16le', # PCM signed 16-bit little-endian
+                '-ar', str(self.cfg.audio_samplerate),
+                '-ac', '2', # Stereo
+                '-i', f'pipe:{audio_fd}',
+            ])
+        else:
+            ffmpeg_command.extend([
+                '-i', str(self.cfg.audio_wav),
+            ])
+
+        ffmpeg_command.extend([
+            '-filter_complex', '[0][1]overlay[out]',
+            '-map', '[out]',
+            '-map', '2:a',
+            '-c:a', 'aac',
+            '-c:v', 'libx264',
+            '-r', str(self.cfg.video_framerate),
+            '-movflags', '+faststart',
+            str(self.cfg.movie_mp4)
+        ])
+
+        print('"' + '" "'.join(ffmpeg_command) + '"')
+        ffmpeg = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, pass_fds=pass_fds)
+        if timidity:
+            # ffmpeg has its own copy now.
+            timidity.stdout.close()
+
+        try:
+            for num, frame in enumerate(stream.frames(self.cfg)):
+                ffmpeg.stdin.write(frame)
+                if (num + 1) % 1000 == 0:
+                    sys.stderr.write(f'Streamed {num+1} frames.\n')
+                    sys.stderr.flush()
+            ffmpeg.stdin.close()
+            ffmpeg.wait()
+            if timidity:
+                timidity.wait()
+        finally:
+            # Only still running if something went wrong; don't leave them
+            # behind, or leave a half-written movie looking finished.
+            for process in (ffmpeg, timidity):
+                if process and process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+
+    def frame_runs(self):
+        '''
+        (cached PNG path, frame count) for each run of identical consecutive
+        foreground frames, from the frame cache manifest.
+        '''
+        frame_cache = cache.FrameCache(self.cfg, self.cfg.layers.foreground)
+        if not frame_cache.manifest_path.exists():
+            raise Exception(f'No frame manifest at {frame_cache.manifest_path}; run the foreground step with frame_cache on first.')
+        previous = None
+        count = 0
+        for frame_number, frame_digest in frame_cache.read_manifest():
+            if frame_digest == previous:
+                count += 1
+                continue
+            if previous:
+                yield frame_cache.cache_path(previous), count
+            previous = frame_digest
+            count = 1
+        if previous:
+            yield frame_cache.cache_path(previous), count
+
+    def write_vfr_mp4(self):
+        '''
+        Like write_bg_fg_mp4, but each run of identical foreground frames goes
+        in once, with a concat file duration covering the whole run, and is
+        encoded variable frame rate.  The concat durations used to get
+        flattened because the input was forced to a constant rate with -r;
+        leaving that off and asking for -fps_mode vfr keeps them.
+        '''
+
+        self.cfg.movie_mp4.parent.mkdir(parents=True, exist_ok=True)
+        concat = self.cfg.layers.foreground.concat.with_suffix('.vfr.concat')
+        concat.parent.mkdir(parents=True, exist_ok=True)
+
+        frames = 0
+        runs = 0
+        with open(concat, 'w', encoding='utf-8') as output:
+            output.write('ffconcat version 1.0\n')
+            for png, count in self.frame_runs():
+                png = png.absolute().as_posix()
+                output.write(f"file '{png}'\n")
+                output.write(f"duration {count / self.cfg.video_framerate}\n")
+                frames += count
+                runs += 1
+            # The concat demuxer ignores the last entry's duration unless the
+            # file is listed again after it.
+            if runs:
+                output.write(f"file '{png}'\n")
+        sys.stderr.write(f'VFR: {frames} frames in {runs} runs ({runs / max(frames, 1):.1%} of frames encoded).\n')
+        sys.stderr.flush()
+
+        timidity_command = [
+            self.cfg.timidity,
+            str(self.cfg.audio_midi),
+            '-s', str(self.cfg.audio_samplerate),
+            '-Or1slS', # 16-bit signed linear PCM stereo
+            '-o', '-', # Pipe to stdout.
+        ]
+
+        ffmpeg_command = [
+            self.cfg.ffmpeg,
+            '-y',
+            '-threads', '0',
+            '-f', 'image2',
+            '-i', str(self.cfg.layers.background.png),
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(concat),
+        ]
+
+        if self.cfg.audio_pipe:
+            ffmpeg_command.extend([
+                '-f', 's16le', # PCM signed 16-bit little-endian
+                '-ar', str(self.cfg.audio_samplerate),
+                '-ac', '2', # Stereo
+                '-i', '-', # Pull audio from stdin.
+            ])
+        else:
+            ffmpeg_command.extend([
+                '-i', str(self.cfg.audio_wav),
+            ])
+
+        ffmpeg_command.extend([
+            '-filter_complex', '[0][1]overlay[out]',
+            '-map', '[out]',
+            '-map', '2:a',
+            '-c:a', 'aac',
+            '-c:v', 'libx264',
+            '-fps_mode', 'vfr',
+            '-movflags', '+faststart',
+            str(self.cfg.movie_mp4)
+        ])
+
+        print('"' + '" "'.join(timidity_command) + '"')
+        print('"' + '" "'.join(ffmpeg_command) + '"')
+        if self.cfg.audio_pipe:
+            timidity = subprocess.Popen(timidity_command, stdout=subprocess.PIPE)
+            ffmpeg = subprocess.Popen(ffmpeg_command, stdin=timidity.stdout)
+            ffmpeg.wait()
+        else:
+            subprocess.call(ffmpeg_command)
@@ -2,10 +2,23 @@
 
 import sys
 import random
+import multiprocessing
 
 import sqlite3
 
 from . import travelling_genome
+from . import connection
+from . import database
+
+# Set just before the route pool forks, like database._shard_state, so the
+# workers inherit the chunks instead of having them pickled across.
+_traveller_state = None
+
+def _traveller_sort_chunk(index):
+    order, chunks, jaccard_offset, solver = _traveller_state
+    chunk = chunks[index]
+    return list(order.traveller_sort(chunk['start'], chunk['end'], chunk['variants'], jaccard_offset, solver))
+
 
 class Order():
 
@@ -201,16 +214,28 @@ class Order():
             'average_times': True,
         },
 
+        'two_world_jaccard20_30w_30s_169w_65n_max20000_group_limit_average_times': {
+            'description': 'Travelling salesman heuristic from south Atlantic to Bering Strait across Africa and Asia, then back to south Atlantic across North and South America, with max route length of 20000.  Use Jaccard distance offset of 20 degrees to make variants which share more locations closer to each other.  Use fixed groups of 20000, even if the times in the group do not all match.  Display average time of variants in group.  Routes found with the neighbour list solver.',
+            'start_location': (-30, -30),
+            'end_location': (-169, 65),
+            'max_route_length': 20000,
+            'two_world': True,
+            'jaccard_offset': 20,
+            'route_group': 'limit',
+            'average_times': True,
+            'solver': 'neighbour_lists',
+        },
+
     }
 
     def __init__(self, cfg):
         self.cfg = cfg
-        random.seed(1234)
+        # Our own generator, so that shuffles don't depend on whatever else
+        # has used the random module.
+        self.random = random.Random(1234)
 
     def select(self):
-        database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        database.row_factory = sqlite3.Row
-        cursor = database.cursor()
+        cursor = connection.readonly(self.cfg).cursor()
         order_key = f'order_{self.cfg.order}'
         lap_key = f'lap_{self.cfg.order}'
         display_time_key = f'display_time_{self.cfg.order}'
@@ -332,26 +357,16 @@ class Order():
         self.traveller(**kwargs)
 
 
-    def traveller(self, start_location, end_location, column_name, max_route_length=0, order_by_spread=False, two_world=False, jaccard_offset=-1, route_group='time', round_years=0, average_times=False):
+    def traveller(self, start_location, end_location, column_name, max_route_length=0, order_by_spread=False, two_world=False, jaccard_offset=-1, route_group='time', round_years=0, average_times=False, solver='two_opt'):
 
         # TODO: Split this into multiple, reasonable functions, instead
         # of this big mess.
 
-        update_template = f'''
-            UPDATE
-                variant
-            SET
-                order_{column_name}=?,
-                lap_{column_name}=?,
-                display_time_{column_name}=?
-            WHERE
-                id=?
-        '''
-            
-        database = sqlite3.connect(self.cfg.database_path)
-        database.row_factory = sqlite3.Row
-        read_cursor = database.cursor()
-        write_cursor = database.cursor()
+        # Not "database", since that's the module with update_from_rows().
+        db = sqlite3.connect(self.cfg.database_path)
+        db.row_factory = sqlite3.Row
+        read_cursor = db.cursor()
+        write_cursor = db.cursor()
 
         #read_cursor.execute('SELECT DISTINCT time FROM variant')
         #times = []
@@ -414,8 +429,9 @@ class Order():
             if order_by_spread:
                 select += ' ORDER BY total_distance_to_average_location'
 
-        order = 0
         lap = 0
+        # Every group's chunks, in order, to be sorted all at once.
+        routes = []
 
         for group in groups:
             sys.stderr.write(f'\nGroup... {group}\n')
@@ -434,7 +450,7 @@ class Order():
                 start = start_location[0] % 360
                 end = end_location[0] % 360
                 #sys.stderr.write(f'start: {start} end: {end}\n')
-                random.shuffle(rows)
+                self.random.shuffle(rows)
                 if max_route_length and len(rows) > max_route_length:
                     route_count = len(rows) // max_route_length + 1
                     prelims = [rows[i::route_count] for i in range(route_count)]
@@ -507,7 +523,7 @@ class Order():
                         position += route_length
 
                 else:
-                    random.shuffle(rows)
+                    self.random.shuffle(rows)
                     route_count = len(rows) // max_route_length + 1
                     variants = [rows[i::route_count] for i in range(route_count)]
 
@@ -532,16 +548,63 @@ class Order():
 
             sys.stderr.write(f'Route lengths: {[len(chunk["variants"]) for chunk in chunks]}\n')
 
+            routes.extend(dict(chunk, display_time=display_time) for chunk in chunks)
+
+        # Chunks don't depend on each other once they're split up, so they
+        # can be sorted in parallel; the results still come back in order.
+        updates = []
+        order = 0
+        for chunk, variant_ids in zip(routes, self.sort_routes(routes, jaccard_offset, solver)):
+            for variant_id in variant_ids:
+                updates.append((variant_id, order, chunk['lap'], chunk['display_time']))
+                order += 1
+
+        # One UPDATE ... FROM for the lot, with the indexes on the columns
+        # being written dropped until it's done, rather than updating both
+        # indexes row by row.
+        sys.stderr.write(f'Writing {len(updates)} variant orders...\n')
+        sys.stderr.flush()
+        write_cursor.execute(f'DROP INDEX IF EXISTS order_{column_name}_idx')
+        write_cursor.execute(f'DROP INDEX IF EXISTS lap_{column_name}_idx')
+        database.update_from_rows(
+            write_cursor,
+            'variant',
+            [f'order_{column_name}', f'lap_{column_name}', f'display_time_{column_name}'],
+            updates,
+        )
+        self.create_order_indexes(write_cursor, column_name)
+
+        db.commit()
+        db.close()
+
+    def sort_routes(self, chunks, jaccard_offset, solver):
+        '''
+        traveller_sort() every chunk across a pool of order_workers
+        processes.  Yields each chunk's sorted variant IDs, in chunk order.
+        '''
+
+        global _traveller_state
+
+        if self.cfg.order_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
             for chunk in chunks:
-                for variant_id in self.traveller_sort(chunk['start'], chunk['end'], chunk['variants'], jaccard_offset, read_cursor):
-                    write_cursor.execute(update_template, (order, chunk['lap'], display_time, variant_id))
-                    order += 1
+                yield list(self.traveller_sort(chunk['start'], chunk['end'], chunk['variants'], jaccard_offset, solver))
+            return
 
+        _traveller_state = (self, chunks, jaccard_offset, solver)
+        try:
+            with multiprocessing.get_context('fork').Pool(self.cfg.order_workers) as pool:
+                for num, variant_ids in enumerate(pool.imap(_traveller_sort_chunk, range(len(chunks)))):
+                    sys.stderr.write(f'Sorted route {num+1}/{len(chunks)}\n')
+                    sys.stderr.flush()
+                    yield variant_ids
+        finally:
+            _traveller_state = None
 
-        database.commit()
-        database.close()
+    def traveller_sort(self, start_location, end_location, variants, jaccard_offset, solver='two_opt'):
 
-    def traveller_sort(self, start_location, end_location, variants, jaccard_offset, read_cursor):
+        # Runs in the route pool workers, which each get their own
+        # connection.
+        read_cursor = connection.readonly(self.cfg).cursor()
 
         # Start isn't a real location.  It's an arbitrary point we picked...
         average_locations = [start_location]
@@ -577,8 +640,11 @@ class Order():
         all_locations.append(set())
         variant_ids.append(-1)
 
-        route = travelling_genome.main(average_locations, jaccard_offset=jaccard_offset, all_locations=all_locations)
-        #route = travelling_genome.nearest_neighbour_only(average_locations)
+        if solver == 'neighbour_lists':
+            # Fast enough for routes of tens of thousands of variants.
+            route = travelling_genome.neighbour_route(average_locations, jaccard_offset=jaccard_offset, all_locations=all_locations, neighbours=self.cfg.tsp_neighbours)
+        else:
+            route = travelling_genome.main(average_locations, jaccard_offset=jaccard_offset, all_locations=all_locations)
 
         # ...so we don't include start_location and end_location in the
         # final route.
@@ -643,16 +709,20 @@ class Order():
                     display_time_%s INTEGER
                 ''' % column_name)
 
-            cursor.execute('''
-                CREATE INDEX order_%s_idx
-                    ON variant (order_%s)
-                ''' % (column_name, column_name))
-
-            cursor.execute('''
-                CREATE INDEX lap_%s_idx
-                    ON variant (lap_%s)
-                ''' % (column_name, column_name))
+            self.create_order_indexes(cursor, column_name)
 
         database.commit()
         database.close()
 
+    def create_order_indexes(self, cursor, column_name):
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS order_%s_idx
+                ON variant (order_%s)
+            ''' % (column_name, column_name))
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS lap_%s_idx
+                ON variant (lap_%s)
+            ''' % (column_name, column_name))
+
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# In-process SVG -> PNG for foreground frames.
+#
+# svg2png.py drives `inkscape --shell`, which is by far the slowest step in
+# the whole pipeline.  The layers only emit circles, paths, rects, text and a
+# couple of drop shadow filters, which the lighter renderers handle fine, so
+# config.rasterizer picks one of:
+#
+#   'inkscape' - the original svg2png.py route.
+#   'cairosvg' - pip install cairosvg
+#   'resvg'    - pip install resvg-py
+#
+# Fonts are whatever the renderer finds on the system, so check output with
+# `run.py rasterizer_check` against frames that Inkscape has already made
+# before switching a full run over.
+
+import sys
+import os
+import pathlib
+import tempfile
+
+from . import svg2png
+from . import render
+
+backends = ['inkscape', 'cairosvg', 'resvg']
+
+
+def cairosvg_renderer(cfg):
+    import cairosvg
+    def render(svg_path, png_path):
+        cairosvg.svg2png(url=str(svg_path), write_to=str(png_path), output_width=cfg.width, output_height=cfg.height)
+    return render
+
+
+def resvg_renderer(cfg):
+    import resvg_py
+    def render(svg_path, png_path):
+        png = resvg_py.svg_to_bytes(
+            svg_path=str(svg_path),
+            width=cfg.width,
+            height=cfg.height,
+            resources_dir=str(pathlib.Path(svg_path).parent),
+        )
+        with open(png_path, 'wb') as output:
+            output.write(bytes(png))
+    return render
+
+
+renderers = {
+    'cairosvg': cairosvg_renderer,
+    'resvg': resvg_renderer,
+}
+
+
+def svg_to_rgba(cfg, svg, base_path, width=None, height=None, backend=None):
+    '''
+    Render an SVG string in memory to a straight-alpha uint8 RGBA array,
+    cfg.width x cfg.height unless told otherwise.  Relative links resolve
+    against base_path.
+    '''
+    import io
+    import numpy
+    import PIL.Image
+    width = width or cfg.width
+    height = height or cfg.height
+    backend = backend or cfg.canvas_rasterizer
+    if backend == 'cairosvg':
+        import cairosvg
+        png = cairosvg.svg2png(bytestring=svg.encode('utf-8'), url=str(base_path), output_width=width, output_height=height)
+    elif backend == 'resvg':
+        import resvg_py
+        png = bytes(resvg_py.svg_to_bytes(svg_string=svg, width=width, height=height, resources_dir=str(pathlib.Path(base_path).parent)))
+    else:
+        raise Exception(f'Rasterizer {backend} cannot render in-process.')
+    return numpy.asarray(PIL.Image.open(io.BytesIO(png)).convert('RGBA'))
+
+
+def rasterize(cfg, svg_template, png_template, frames, frame_convert=int, backend=None, finished=None):
+    '''
+    Render each frame's SVG to PNG with the configured backend.  If given,
+    finished(png_path) is called as each frame comes back.
+    '''
+    backend = backend or cfg.rasterizer
+    if backend not in backends:
+        raise Exception(f'Unknown rasterizer: {backend}')
+
+    if backend == 'inkscape':
+        svg2png.svg2png(cfg, svg_template, png_template, frames, frame_convert=frame_convert, finished=finished)
+        return
+
+    renderer = renderers[backend]
+
+    def factory(cfg):
+        draw = renderer(cfg)
+        return render.per_frame(lambda paths: draw(*paths) or paths[1])
+
+    sys.stderr.write(f'Rasterizing with {backend}... {svg_template} -> {png_template}\n')
+    sys.stderr.flush()
+    sidecar = None
+    if cfg.resume:
+        sidecar = svg2png.Sidecar(png_template)
+        frames = sidecar.stale(frames, svg_template, png_template, frame_convert)
+    paths = ((str(svg_template) % frame_convert(frame), str(png_template) % frame_convert(frame)) for frame in frames)
+    for num, png in enumerate(render.imap(cfg, factory, paths)):
+        if sidecar:
+            sidecar.done(png)
+        if finished:
+            finished(png)
+        if (num + 1) % cfg.render_chunk_frames == 0:
+            sys.stderr.write(f'Rasterized {num+1} frames.\n')
+            sys.stderr.flush()
+    sys.stderr.write('Rasterizing complete.\n')
+    sys.stderr.flush()
+
+
+def compare_png(reference_path, test_path, tolerance):
+    '''
+    Returns (largest channel difference, fraction of pixels with any channel
+    more than tolerance away) between two PNGs of the same size.
+    '''
+    from PIL import Image
+    import numpy
+    reference = numpy.asarray(Image.open(reference_path).convert('RGBA'), dtype=numpy.int16)
+    test = numpy.asarray(Image.open(test_path).convert('RGBA'), dtype=numpy.int16)
+    if reference.shape != test.shape:
+        raise Exception(f'Size mismatch: {reference_path} {reference.shape} vs {test_path} {test.shape}')
+    difference = numpy.abs(reference - test)
+    bad = (difference > tolerance).any(axis=2)
+    return int(difference.max()), float(bad.mean())
+
+
+def check(cfg, svg_template, png_template, frames, frame_convert=int, backend=None):
+    '''
+    Render the first few frames with the configured backend and compare them
+    against the Inkscape PNGs already at png_template.  Returns True if every
+    frame is within config.rasterizer_tolerance.
+    '''
+    backend = backend or cfg.rasterizer
+    if backend not in backends:
+        raise Exception(f'Unknown rasterizer: {backend}.  Choices are {", ".join(backends)}.')
+    if backend == 'inkscape':
+        # Nothing to compare: the reference frames are Inkscape's.
+        sys.stderr.write(f'rasterizer is set to inkscape, which is what the check compares against.  Set rasterizer to one of {", ".join(renderers)} to check it.\n')
+        sys.stderr.flush()
+        return False
+    draw = renderers[backend](cfg)
+
+    passed = True
+    checked = 0
+    with tempfile.TemporaryDirectory() as folder:
+        for frame in frames:
+            if checked >= cfg.rasterizer_check_frames:
+                break
+            index = frame_convert(frame)
+            reference_path = str(png_template) % index
+            if not os.path.exists(reference_path):
+                continue
+            test_path = os.path.join(folder, f'{checked}.png')
+            draw(str(svg_template) % index, test_path)
+            largest, fraction = compare_png(reference_path, test_path, cfg.rasterizer_tolerance)
+            ok = fraction <= cfg.rasterizer_max_bad_fraction
+            passed = passed and ok
+            checked += 1
+            sys.stderr.write(f'{"ok" if ok else "FAIL"} {reference_path}: max difference {largest}, {fraction:.4%} of pixels over tolerance\n')
+            sys.stderr.flush()
+
+    if not checked:
+        sys.stderr.write(f'No Inkscape frames found at {png_template} to check against.\n')
+        return False
+    sys.stderr.write(f'{backend} {"matches" if passed else "does not match"} Inkscape on {checked} frames.\n')
+    sys.stderr.flush()
+    return passed
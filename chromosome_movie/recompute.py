@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Recalculate the variant columns which are derived from the population
+# tables (average location, average distance to average location and region
+# count) without going back to the treeseq.  Useful for trying out
+# weighted_average_locations or different region definitions, which
+# otherwise need a multi-hour database rebuild.
+
+import sys
+
+import sqlite3
+import numpy
+
+from . import database
+
+class Recompute():
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def write_db(self):
+
+        connection = sqlite3.connect(self.cfg.database_path)
+        cursor = connection.cursor()
+
+        self.update_regions(cursor)
+
+        populations = database.population_arrays(cursor)
+
+        sys.stderr.write('Reading variant populations...\n')
+        sys.stderr.flush()
+
+        # Only pattern-owning variants have variant_population rows, so
+        # we calculate once per distinct pattern and then copy the results
+        # to every variant which matches it.
+        cursor.execute('SELECT variant_id, population_id, node_count FROM variant_population ORDER BY variant_id, population_id')
+        rows = numpy.array(cursor.fetchall(), dtype=numpy.int64).reshape(-1, 3)
+        variant_ids, population_ids, node_counts = rows[:, 0], rows[:, 1], rows[:, 2]
+
+        match_ids, starts = numpy.unique(variant_ids, return_index=True)
+        offsets = numpy.append(starts, len(variant_ids))
+
+        sys.stderr.write(f'Recomputing {len(match_ids)} population count patterns...\n')
+        sys.stderr.flush()
+
+        if self.cfg.weighted_average_locations:
+            weights = node_counts / populations['node_count'][population_ids]
+        else:
+            weights = None
+        longitudes, latitudes, distances = database.average_locations(offsets, populations['longitude'][population_ids], populations['latitude'][population_ids], weights)
+
+        region_counts = self.region_counts(offsets, populations['region'][population_ids])
+
+        database.update_from_rows(
+            cursor,
+            'variant',
+            ['average_longitude', 'average_latitude', 'average_distance_to_average_location', 'region_count'],
+            zip(match_ids.tolist(), longitudes.tolist(), latitudes.tolist(), distances.tolist(), region_counts.tolist()),
+            match='population_counts_match_variant_id',
+        )
+
+        connection.commit()
+        connection.close()
+
+        sys.stderr.write('Recompute done.\n')
+        sys.stderr.flush()
+
+    def update_regions(self, cursor):
+        # Regions come from the config rather than the treeseq, so pick up
+        # any changes to them.
+        cursor.execute('SELECT id, source, name FROM population')
+        entries = [(self.cfg.layers.populations.position[(source, name)][3], population_id) for population_id, source, name in cursor.fetchall()]
+        cursor.executemany('UPDATE population SET region=? WHERE id=?', entries)
+
+    def region_counts(self, offsets, regions):
+        '''
+        Number of distinct regions in each CSR segment.
+        '''
+        segments = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+        # Regions are small non-negative integers, apart from -1 for
+        # populations we don't know about, so shift them up by one to
+        # make a single sortable key per (segment, region) pair.
+        span = regions.max() + 2
+        pairs = numpy.unique(segments * span + regions + 1)
+        return numpy.bincount(pairs // span, minlength=len(offsets) - 1)
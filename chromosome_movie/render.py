@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Process pool for frame rendering.
+#
+# Frames are split into runs of render_chunk_frames and handed to a pool of
+# render_workers forked processes.  Each worker builds its renderer once (so
+# e.g. cairosvg is imported and set up once per process, not per frame) and
+# keeps it for every chunk it gets.  A renderer takes a list of frames and
+# returns a list of results; per_frame() wraps a one-frame-at-a-time
+# function.  Results come back in frame order, so a caller can stream them.
+#
+# Hangs are handled the way svg2png's timeout controller does it: a chunk
+# gets per-frame timeout * frames to finish, and if it doesn't, the workers
+# are killed (along with any Inkscape they started) and the unfinished
+# chunks are run again from scratch.  Only as many chunks as there are
+# workers are in flight at once, so every chunk's clock starts when it
+# actually starts running.
+
+import sys
+import os
+import time
+import signal
+import collections
+import multiprocessing
+
+# Set in the parent before forking, like database._shard_state.
+_render_state = None
+# The worker's own renderer, built by _start_worker().
+_renderer = None
+# Subprocesses a renderer has running, so a terminated worker can take them
+# down with it.
+children = set()
+
+
+def _stop_worker(signum, frame):
+    for child in list(children):
+        try:
+            child.kill()
+        except OSError:
+            pass
+    os._exit(1)
+
+
+def _start_worker():
+    global _renderer
+    cfg, factory = _render_state
+    signal.signal(signal.SIGTERM, _stop_worker)
+    _renderer = factory(cfg)
+
+
+def _render_chunk(chunk):
+    return _renderer(chunk)
+
+
+def per_frame(render):
+    return lambda chunk: [render(item) for item in chunk]
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def available():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def imap(cfg, factory, items, workers=None, chunk_frames=None, frame_timeout=None):
+    '''
+    Yields factory(cfg)(item) for each item, in order, computed across a
+    pool of worker processes.  factory is called once in each worker.
+    '''
+    global _render_state
+
+    workers = workers or cfg.render_workers
+    chunk_frames = chunk_frames or cfg.render_chunk_frames
+    frame_timeout = frame_timeout or cfg.render_frame_timeout
+
+    if not available():
+        sys.stderr.write('No fork() on this platform, rendering in one process.\n')
+        sys.stderr.flush()
+        render = factory(cfg)
+        for chunk in chunked(items, chunk_frames):
+            yield from render(chunk)
+        return
+
+    context = multiprocessing.get_context('fork')
+    _render_state = (cfg, factory)
+
+    def start_pool():
+        return context.Pool(workers, initializer=_start_worker)
+
+    def submit(pool, chunk):
+        return pool.apply_async(_render_chunk, (chunk,)), time.monotonic()
+
+    chunks = chunked(items, chunk_frames)
+    # (chunk, async result, start time) in frame order.
+    pending = collections.deque()
+    pool = start_pool()
+    try:
+        while True:
+            while len(pending) < workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk,) + submit(pool, chunk))
+            if not pending:
+                break
+
+            chunk, result, started = pending[0]
+            remaining = started + frame_timeout * len(chunk) - time.monotonic()
+            try:
+                results = result.get(timeout=max(remaining, 0))
+            except multiprocessing.TimeoutError:
+                sys.stderr.write(f'Render chunk of {len(chunk)} frames timed out, restarting workers.\n')
+                sys.stderr.flush()
+                pool.terminate()
+                pool.join()
+                pool = start_pool()
+                # Anything that hadn't finished died with the pool.
+                pending = collections.deque(
+                    (chunk, result, started) if result.ready() else (chunk,) + submit(pool, chunk)
+                    for chunk, result, started in pending
+                )
+                continue
+
+            pending.popleft()
+            yield from results
+    finally:
+        pool.terminate()
+        pool.join()
+        _render_state = None
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# LRU cache of rasterized layer sprites for Foreground.draw().
+#
+# Most layers only ever show a limited set of distinct pictures - the same
+# local frequencies pattern, average location dot, date or caption turns up
+# over and over - so each layer's SVG for a frame is keyed by (layer name,
+# hash of the SVG), rasterized once into a small RGBA sprite covering just the
+# layer's box, and blitted into the frame from then on.  The cache holds up
+# to sprite_cache_mb of sprites and throws out the least recently used.
+
+import sys
+import collections
+
+class SpriteCache():
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.limit = self.cfg.sprite_cache_mb * 1024**2
+        self.size = 0
+        self.sprites = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        '''
+        The cached (left, top, rgba, bbox) for key, calling make() for it on
+        a miss.
+        '''
+        if key in self.sprites:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+
+        self.misses += 1
+        sprite = make()
+        self.sprites[key] = sprite
+        self.size += sprite[2].nbytes
+        while self.size > self.limit and len(self.sprites) > 1:
+            old_key, old_sprite = self.sprites.popitem(last=False)
+            self.size -= old_sprite[2].nbytes
+        return sprite
+
+    def report(self):
+        total = self.hits + self.misses
+        sys.stderr.write(f'Sprites: {self.misses} rendered, {self.hits} reused ({self.hits / max(total, 1):.1%}), {len(self.sprites)} cached in {self.size / 1024**2:.0f}MB\n')
+        sys.stderr.flush()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Render foreground frames in worker processes and hand them back, in order,
+# as raw RGBA bytes, so that they can go straight into ffmpeg without ever
+# touching disk as PNGs.
+#
+# Frames are dealt out to workers in runs of stream_chunk_frames: run k goes
+# to worker k % stream_workers.  The frame order is worked out once, in the
+# parent, so that every worker sees the same sequence even for a time_random
+# order.  Every worker walks the whole of it, drawing its own runs and only
+# advance()ing the stateful layers through everyone else's, so histogram
+# windows and traces come out exactly as they would in a single pass.  Each worker has its own bounded queue, and the
+# parent reads the queues in frame order; a worker that gets ahead just
+# blocks on its full queue, which keeps at most
+# stream_workers * stream_queue_frames frames in memory.
+#
+# Without fork(), or with a single worker, frames are drawn in this process.
+
+import sys
+import multiprocessing
+
+from . import composite, order, render
+
+# Set in the parent before forking, like database._shard_state.
+_stream_state = None
+
+def _render_worker(worker, frames):
+    cfg, variants = _stream_state
+    foreground = composite.Foreground(cfg)
+    try:
+        for variant in variants:
+            frame_number = variant['frame_number']
+            if (frame_number // cfg.stream_chunk_frames) % cfg.stream_workers == worker:
+                frames.put(foreground.draw(variant).rgba().tobytes())
+            else:
+                foreground.advance(variant)
+        foreground.report()
+    finally:
+        frames.put(None)
+
+
+def frames(cfg):
+    '''
+    Yields each foreground frame as cfg.width x cfg.height RGBA bytes, in
+    frame order.
+    '''
+    global _stream_state
+
+    if cfg.stream_workers <= 1 or not render.available():
+        if cfg.stream_workers > 1:
+            sys.stderr.write('No fork() on this platform, drawing frames in one process.\n')
+            sys.stderr.flush()
+        foreground = composite.Foreground(cfg)
+        for variant in foreground.order.select():
+            yield foreground.draw(variant).rgba().tobytes()
+        foreground.report()
+        return
+
+    # Workers inherit this list, so they all agree on which variant is
+    # which frame.
+    _stream_state = (cfg, list(order.Order(cfg).select()))
+
+    context = multiprocessing.get_context('fork')
+    queues = [context.Queue(cfg.stream_queue_frames) for _ in range(cfg.stream_workers)]
+    workers = [context.Process(target=_render_worker, args=(worker, queue), daemon=True) for worker, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        run = 0
+        while True:
+            worker = run % cfg.stream_workers
+            for _ in range(cfg.stream_chunk_frames):
+                frame = queues[worker].get()
+                if frame is None:
+                    # Runs are contiguous, so the first worker to run out
+                    # marks the end of the movie - unless it crashed.
+                    workers[worker].join()
+                    if workers[worker].exitcode != 0:
+                        raise Exception(f'Render worker {worker} failed with exit code {workers[worker].exitcode}')
+                    return
+                yield frame
+            run += 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        _stream_state = None
@@ -2,9 +2,16 @@
 
 import sys
 import os
+import pathlib
 import subprocess
 import threading
 import queue
+import time
+import re
+import struct
+import hashlib
+
+from . import render
 
 '''
 Start one thread to generate actionlists and put them on the queue.
@@ -125,7 +132,221 @@ def control_inkscape(actions_queue, inkscape_exe, working_directory):
 
 
 
-def svg2png(cfg, svg_template, png_template, frames=None, frame_convert=int, inkscape_actions=''):
+def inkscape_renderer(inkscape_exe, working_directory, inkscape_actions):
+    '''
+    render.imap() renderer: one `inkscape --shell` per chunk of
+    (svg, png) pairs.  Like InkscapeShell, reports (svg, png, produced) so
+    that frames Inkscape didn't make can be re-queued.
+    '''
+    def run(chunk):
+        for svg, png in chunk:
+            path = os.path.join(working_directory, png)
+            if os.path.exists(path):
+                os.remove(path)
+        actions = [f'file-open:{svg};export-filename:{png};{inkscape_actions}export-do;file-close;' for svg, png in chunk]
+        actions.append('quit-inkscape;')
+        process = subprocess.Popen([inkscape_exe, '--shell'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=working_directory, encoding='utf-8')
+        render.children.add(process)
+        process.communicate('\n'.join(actions) + '\n')
+        render.children.discard(process)
+        if process.returncode != 0:
+            sys.stderr.write(f'Inkscape failed with exit code {process.returncode}: {chunk[0][0]}...\n')
+            sys.stderr.flush()
+        return [(svg, png, png_complete(os.path.join(working_directory, png))) for svg, png in chunk]
+    return lambda cfg: run
+
+
+# Every complete PNG ends with an empty IEND chunk: zero length, type, CRC.
+png_trailer = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+def png_complete(path):
+    try:
+        with open(path, 'rb') as png:
+            png.seek(-len(png_trailer), os.SEEK_END)
+            return png.read() == png_trailer
+    except OSError:
+        return False
+
+
+def png_size(path):
+    '''
+    (width, height) from a PNG's IHDR chunk, or None if it isn't a PNG.
+    '''
+    try:
+        with open(path, 'rb') as png:
+            header = png.read(24)
+    except OSError:
+        return None
+    if len(header) < 24 or header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def svg_size(svg):
+    '''
+    The PNG size Inkscape will export an SVG at, from its viewBox, or None.
+    '''
+    match = re.search(r'viewBox="\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)\s*"', svg[:1000])
+    if not match:
+        return None
+    return tuple(int(round(float(size))) for size in match.groups())
+
+
+def digest(contents):
+    return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+
+class Sidecar():
+
+    '''
+    Resume support.  Next to the PNGs we keep frames.hash, a log of
+    "png-name digest" lines recording which SVG contents each PNG was made
+    from.  A frame is up to date if its PNG is complete, the right size,
+    and was made from the same SVG contents we have now.  Lines are only
+    ever appended, so a crash loses at most the line being written.
+    '''
+
+    def __init__(self, png_template):
+        self.path = pathlib.Path(png_template).parent/'frames.hash'
+        self.hashes = {}
+        self.pending = {}
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as lines:
+                for line in lines:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self.hashes[fields[0]] = fields[1]
+
+    def current(self, png, svg_digest, size=None):
+        name = os.path.basename(png)
+        if self.hashes.get(name) != svg_digest or not png_complete(png):
+            return False
+        return size is None or png_size(png) == size
+
+    def stale(self, frames, svg_template, png_template, frame_convert):
+        '''
+        Yields just the frames whose PNGs need (re)making, remembering the
+        SVG digests so that done() can record them.
+        '''
+        skipped = 0
+        for frame in frames:
+            svg = str(svg_template) % frame_convert(frame)
+            png = str(png_template) % frame_convert(frame)
+            try:
+                with open(svg, 'rb') as contents:
+                    svg_contents = contents.read()
+            except FileNotFoundError:
+                # Foreground.write_svg doesn't write SVGs for frames that
+                # are already up to date.
+                if os.path.basename(png) in self.hashes and png_complete(png):
+                    skipped += 1
+                    continue
+                raise
+            svg_digest = digest(svg_contents)
+            if self.current(png, svg_digest, svg_size(svg_contents.decode('utf-8'))):
+                skipped += 1
+                continue
+            self.pending[os.path.basename(png)] = svg_digest
+            yield frame
+        sys.stderr.write(f'Resume: {skipped} frames already done.\n')
+        sys.stderr.flush()
+
+    def done(self, png):
+        name = os.path.basename(png)
+        svg_digest = self.pending.pop(name, None)
+        if svg_digest and png_complete(png):
+            self.hashes[name] = svg_digest
+            with open(self.path, 'a', encoding='utf-8') as output:
+                output.write(f'{name} {svg_digest}\n')
+
+    def commit(self, png_folder):
+        for name in list(self.pending):
+            self.done(os.path.join(png_folder, name))
+
+
+class InkscapeShell():
+
+    '''
+    One long-lived `inkscape --shell` fed a frame at a time.  A frame counts
+    as done when its PNG shows up complete on disk.  If it doesn't within
+    inkscape_frame_timeout, Inkscape is killed and restarted and the frame
+    is reported missing; everything else carries on.  Inkscape is also
+    restarted every inkscape_recycle_frames frames, since it seems to leak.
+    '''
+
+    def __init__(self, cfg, inkscape_exe, working_directory, inkscape_actions):
+        self.cfg = cfg
+        self.inkscape_exe = inkscape_exe
+        self.working_directory = working_directory
+        self.inkscape_actions = inkscape_actions
+        self.process = None
+        self.frames = 0
+        self.started = False
+
+    def start(self):
+        self.process = subprocess.Popen([self.inkscape_exe, '--shell'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=self.working_directory, encoding='utf-8')
+        render.children.add(self.process)
+        self.frames = 0
+        self.started = True
+
+    def stop(self, kill=False):
+        if not self.process:
+            return
+        if not kill:
+            try:
+                self.process.communicate('quit-inkscape;\n', timeout=self.cfg.inkscape_frame_timeout)
+            except (subprocess.TimeoutExpired, OSError):
+                kill = True
+        if kill:
+            self.process.kill()
+            self.process.wait()
+        render.children.discard(self.process)
+        self.process = None
+
+    def export(self, svg, png):
+        '''
+        Returns True if the frame was produced.
+        '''
+        if not self.process or self.frames >= self.cfg.inkscape_recycle_frames:
+            self.stop()
+            self.start()
+
+        timeout = self.cfg.inkscape_frame_timeout
+        if self.started:
+            # First frame pays for Inkscape starting up.
+            timeout += self.cfg.inkscape_start_timeout
+            self.started = False
+
+        path = os.path.join(self.working_directory, png)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            self.process.stdin.write(f'file-open:{svg};export-filename:{png};{self.inkscape_actions}export-do;file-close;\n')
+            self.process.stdin.flush()
+        except OSError:
+            self.stop(kill=True)
+            return False
+
+        deadline = time.monotonic() + timeout
+        while not png_complete(path):
+            if time.monotonic() > deadline or self.process.poll() is not None:
+                sys.stderr.write(f'Inkscape did not produce {png}, restarting it.\n')
+                sys.stderr.flush()
+                self.stop(kill=True)
+                return False
+            time.sleep(0.01)
+        self.frames += 1
+        return True
+
+    def __call__(self, chunk):
+        return [(svg, png, self.export(svg, png)) for svg, png in chunk]
+
+
+def inkscape_shell_renderer(inkscape_exe, working_directory, inkscape_actions):
+    return lambda cfg: InkscapeShell(cfg, inkscape_exe, working_directory, inkscape_actions)
+
+
+def svg2png(cfg, svg_template, png_template, frames=None, frame_convert=int, inkscape_actions='', finished=None):
 
     inkscape_exe = os.fspath(cfg.inkscape)
 
@@ -140,9 +361,53 @@ def svg2png(cfg, svg_template, png_template, frames=None, frame_convert=int, ink
 
         actions = [f'file-open:{svg_relative};export-filename:{png_relative};{inkscape_actions}export-do;quit-inkscape;']
         run_inkscape(inkscape_exe, working_directory, 1, 1, actions)
+        return
+
+    sidecar = None
+    if cfg.resume:
+        sidecar = Sidecar(png_template)
+        frames = sidecar.stale(frames, svg_template, png_template, frame_convert)
+
+    def done(png):
+        path = os.path.join(working_directory, png)
+        if sidecar:
+            sidecar.done(path)
+        if finished:
+            finished(path)
+
+    if render.available():
+
+        pairs = ((svg_relative % frame_convert(frame), png_relative % frame_convert(frame)) for frame in frames)
+        if cfg.inkscape_pool:
+            factory = inkscape_shell_renderer(inkscape_exe, working_directory, inkscape_actions)
+            # Per-frame timeouts are handled by the shells; the pool's chunk
+            # timeout is just a backstop.
+            frame_timeout = cfg.inkscape_frame_timeout + cfg.inkscape_start_timeout
+        else:
+            factory = inkscape_renderer(inkscape_exe, working_directory, inkscape_actions)
+            frame_timeout = None
+        for attempt in range(cfg.inkscape_frame_retries + 1):
+            missing = []
+            for num, (svg, png, produced) in enumerate(render.imap(cfg, factory, pairs, frame_timeout=frame_timeout)):
+                if produced:
+                    done(png)
+                else:
+                    missing.append((svg, png))
+                if (num + 1) % cfg.render_chunk_frames == 0:
+                    sys.stderr.write(f'Converted {num+1} frames.\n')
+                    sys.stderr.flush()
+            if not missing:
+                break
+            sys.stderr.write(f'Re-queuing {len(missing)} frames that were not produced.\n')
+            sys.stderr.flush()
+            pairs = missing
+        else:
+            raise Exception(f'Inkscape could not produce {len(missing)} frames, e.g. {missing[0][1]}')
+        sys.stderr.write('Inkscape work complete.\n')
 
     else:
 
+        # The thread controller below is still the way to go on Windows.
         #thread_count = os.cpu_count() - 1
         thread_count = 1
         threads = []
@@ -160,6 +425,8 @@ def svg2png(cfg, svg_template, png_template, frames=None, frame_convert=int, ink
         sys.stderr.write('Inkscape work started.\n')
         producer.join()
         actions_queue.join()
+        if sidecar:
+            sidecar.commit(os.path.dirname(png_template))
         sys.stderr.write('Inkscape work complete.\n')
 
 
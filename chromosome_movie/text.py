@@ -1,12 +1,13 @@
 import re
 import datetime
 from xml.sax import saxutils
-import sqlite3
 
 import srt
 
 from . import svg2png
 from . import drop_shadow
+from . import columns
+from . import connection
 
 class Text():
 
@@ -162,9 +163,7 @@ class Date(Text):
         return int(10 * variant['time'])
 
     def select(self):
-        database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        database.row_factory = sqlite3.Row
-        cursor = database.cursor()
+        cursor = connection.readonly(self.cfg).cursor()
         cursor.execute('SELECT DISTINCT time FROM variant')
         return cursor
 
@@ -198,9 +197,7 @@ class Variant(Text):
         return variant[self.order_key]
 
     def select(self):
-        database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        database.row_factory = sqlite3.Row
-        cursor = database.cursor()
+        cursor = connection.readonly(self.cfg).cursor()
         cursor.execute(f'SELECT id, chromosome_position, {self.order_key} FROM variant ORDER BY {self.order_key}')
         return cursor
 
@@ -244,8 +241,8 @@ class Populations(Text):
     def __init__(self, cfg):
         self.layercfg = cfg.layers.populations
         super().__init__(cfg)
-        self.database = sqlite3.connect(self.cfg.database_readonly_uri, uri=True)
-        self.database.row_factory = sqlite3.Row
+        self.database = connection.readonly(self.cfg)
+        self.population_index = columns.population_index(cfg)
 
     def index(self, variant):
         return variant[self.order_key]
@@ -267,21 +264,7 @@ class Populations(Text):
         for key, source in self.layercfg.source.items():
             svg += f'''<text x="{source['left']}" y="{source['top']}" font-size="{self.layercfg.font_size}" font-style="italic" style="{self.layercfg.style}{shadow}">{source['title']}</text>\n'''
 
-        cursor = self.database.cursor()
-        cursor.execute('''
-            SELECT
-                population.source AS source, population.name AS name
-            FROM
-                variant_population
-            JOIN
-                population
-            ON
-                variant_population.population_id = population.id
-            WHERE
-                variant_population.variant_id = ?
-        ''', (variant['population_counts_match_variant_id'],))
-
-        for source, name in cursor:
+        for source, name in self.population_index.names(variant['population_counts_match_variant_id']):
             column, row, name, region = self.layercfg.position[(source, name)]
             left = self.layercfg.source[source]['left'] + self.layercfg.source[source]['column'][column]
             top = self.layercfg.source[source]['top'] + (2 + row) * self.layercfg.line_spacing * self.layercfg.font_size
@@ -8,6 +8,10 @@ In this module, oordinates/locations are always (longitude, latitude).
 This gets dramatically slower as the number of locations to visit gets larger.
 Not unexpected, but I still bet that someone could make this much faster, and
 probably fix bugs in my algorithms.
+
+neighbour_route() is the faster one: it only ever looks at each location's
+few nearest neighbours, and improves the route in place with 2-opt and
+Or-opt moves, so it can handle routes of tens of thousands of locations.
 '''
 
 # Great circle based on:
@@ -21,6 +25,7 @@ probably fix bugs in my algorithms.
 import sys
 from math import radians, degrees, sin, cos, acos
 import random
+import collections
 #import itertools
 import numpy
 
@@ -53,15 +58,8 @@ def build_distance_matrix(average_locations, jaccard_offset=-1, all_locations=No
 
     if jaccard_offset >= 0:
         distance_matrix += jaccard_offset
-        for i in range(len(average_locations)):
-            for j in range(len(average_locations)):
-                intersection = all_locations[i] & all_locations[j]
-                union = all_locations[i] | all_locations[j]
-                if len(union) == 0:
-                    jaccard_similarity = 0
-                else:
-                    jaccard_similarity = len(intersection) / len(union)
-                distance_matrix[i,j] *= (1 - jaccard_similarity)
+        for rows, jaccard_similarity in jaccard_similarities(all_locations):
+            distance_matrix[rows] *= 1 - jaccard_similarity
     #distance_matrix = numpy.sin(lat0) * numpy.sin(lat1)
 
     #sys.stderr.write(f'Distance matrix shape: {distance_matrix.shape}\n')
@@ -69,6 +67,36 @@ def build_distance_matrix(average_locations, jaccard_offset=-1, all_locations=No
     #return numpy.degrees(distance_matrix)
 
 
+def jaccard_similarities(all_locations, block_rows=2048):
+    '''
+    Jaccard similarity of every pair of sets in all_locations, as
+    (row slice, block of rows) pairs so that only one block of floats is
+    around at a time.
+
+    The sets become rows of a 0/1 variant x location matrix, so the size of
+    every intersection comes out of one matrix product, and the unions are
+    just |a| + |b| - |a & b|.  Two empty sets have similarity 0.
+    '''
+    columns = {}
+    rows = []
+    cols = []
+    for i, locations in enumerate(all_locations):
+        for location in locations:
+            rows.append(i)
+            cols.append(columns.setdefault(location, len(columns)))
+    # float32 counts are exact far past any number of locations we'll see,
+    # and the product goes through BLAS.
+    membership = numpy.zeros((len(all_locations), max(len(columns), 1)), dtype=numpy.float32)
+    membership[rows, cols] = 1
+    sizes = membership.sum(axis=1)
+
+    for start in range(0, len(all_locations), block_rows):
+        rows = slice(start, start + block_rows)
+        intersection = membership[rows] @ membership.T
+        union = sizes[rows, None] + sizes[None, :] - intersection
+        yield rows, numpy.divide(intersection, union, out=numpy.zeros_like(intersection), where=union > 0)
+
+
 def great_circle_angle(longitude0, latitude0, longitude1, latitude1):
     if longitude0 == longitude1 and latitude0 == latitude1:
         return 0
@@ -163,8 +191,82 @@ def two_opt(distance_matrix, initial_route, improvement_threshold=0.01):
 
 
 def nearest_neighbour(distance_matrix):
-    # There's probably a better way to do nearest neighbour.
-    #sys.stderr.write(f'Nearest neighbour matrix: {distance_matrix.shape}\n')
+    # Visited columns are masked out with infinity, so each step is a single
+    # argmin over the current row.  Ties go to the lowest index, as before.
+    first = 0
+    last = len(distance_matrix) - 1
+    unvisited = numpy.ones(len(distance_matrix), dtype=bool)
+    unvisited[[first, last]] = False
+    route = [first]
+    current = first
+    for _ in range(last - 1):
+        current = int(numpy.argmin(numpy.where(unvisited, distance_matrix[current], numpy.inf)))
+        unvisited[current] = False
+        route.append(current)
+    route.append(last)
+    return route
+
+
+def nearest_neighbour_points(xyz):
+    '''
+    nearest_neighbour() straight from unit-sphere points, for when the
+    matrix would be too big: the closest point is the one with the largest
+    dot product.  Uses a k-d tree if scipy is available.
+    '''
+    first = 0
+    last = len(xyz) - 1
+    if last < 2:
+        return list(range(len(xyz)))
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    unvisited = numpy.ones(len(xyz), dtype=bool)
+    unvisited[[first, last]] = False
+    route = [first]
+    current = first
+
+    if cKDTree is None:
+        closeness = numpy.empty(len(xyz))
+        for _ in range(last - 1):
+            numpy.dot(xyz, xyz[current], out=closeness)
+            closeness[~unvisited] = -numpy.inf
+            current = int(numpy.argmax(closeness))
+            unvisited[current] = False
+            route.append(current)
+        route.append(last)
+        return route
+
+    # The tree only holds points that were unvisited when it was built.
+    # Visited ones are skipped by asking for more neighbours, and once half
+    # the tree is visited it gets rebuilt from what's left.
+    remaining = numpy.flatnonzero(unvisited)
+    tree = cKDTree(xyz[remaining])
+    left = len(remaining)
+    while left:
+        k = 8
+        while True:
+            k = min(k, len(remaining))
+            _, found = tree.query(xyz[current], k)
+            candidates = remaining[numpy.atleast_1d(found)]
+            fresh = unvisited[candidates]
+            if fresh.any():
+                current = int(candidates[numpy.argmax(fresh)])
+                break
+            k *= 4
+        unvisited[current] = False
+        route.append(current)
+        left -= 1
+        if left and left <= len(remaining) // 2:
+            remaining = numpy.flatnonzero(unvisited)
+            tree = cKDTree(xyz[remaining])
+    route.append(last)
+    return route
+
+
+def old_nearest_neighbour(distance_matrix):
+    # The original, for comparison in benchmark().
     first = 0
     last = len(distance_matrix) - 1
     visited = set()
@@ -203,6 +305,233 @@ def main(average_locations, jaccard_offset=-1, all_locations=None):
     return good_route
 
 
+# The neighbour list engine.
+#
+# Instead of a full distance matrix, every location gets a list of its k
+# nearest neighbours (found with a k-d tree on points on the unit sphere) and
+# distances are worked out when they're needed.  Improving moves are only
+# tried towards those neighbours, and only for locations whose "don't look"
+# bit is off: a location that yielded nothing gets skipped until a move
+# changes one of its edges.  The route is a plain list plus a position list,
+# so a move is checked by its change in distance alone and applied by
+# reversing or shifting a slice in place.
+#
+# As everywhere else in here, the first and last locations stay put.
+
+def unit_vectors(locations):
+    longitude = numpy.radians(numpy.array([l[0] for l in locations], dtype=numpy.float64))
+    latitude = numpy.radians(numpy.array([l[1] for l in locations], dtype=numpy.float64))
+    return numpy.stack((
+        numpy.cos(latitude) * numpy.cos(longitude),
+        numpy.cos(latitude) * numpy.sin(longitude),
+        numpy.sin(latitude),
+    ), axis=1)
+
+
+def nearest_indices(xyz, k):
+    '''
+    Indices of the (up to) k nearest other points for each point, nearest
+    first.  Straight-line distance on the unit sphere sorts the same way as
+    great circle distance.
+    '''
+    count = len(xyz)
+    k = min(k, count - 1)
+    if k <= 0:
+        return [[] for _ in range(count)]
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    if cKDTree is not None:
+        _, indices = cKDTree(xyz).query(xyz, k + 1)
+    else:
+        # No scipy: brute force, a block of rows at a time so we never hold
+        # the whole matrix.
+        indices = numpy.empty((count, k + 1), dtype=numpy.int64)
+        for start in range(0, count, 1024):
+            closeness = xyz[start:start+1024] @ xyz.T
+            nearest = numpy.argpartition(-closeness, k, axis=1)[:, :k+1]
+            order = numpy.argsort(-numpy.take_along_axis(closeness, nearest, axis=1), axis=1)
+            indices[start:start+1024] = numpy.take_along_axis(nearest, order, axis=1)
+
+    # Points often share a location, so a point isn't always first in its
+    # own list.
+    return [[j for j in row if j != i][:k] for i, row in enumerate(indices.tolist())]
+
+
+def distance_function(xyz, jaccard_offset=-1, all_locations=None):
+    '''
+    distance(i, j) in degrees, the same as build_distance_matrix() would give
+    (including the Jaccard weighting), without the matrix.
+    '''
+    points = [tuple(point) for point in xyz.tolist()]
+
+    def angle(i, j):
+        ix, iy, iz = points[i]
+        jx, jy, jz = points[j]
+        return degrees(acos(min(max(ix*jx + iy*jy + iz*jz, -1), 1)))
+
+    if jaccard_offset < 0:
+        return angle
+
+    def distance(i, j):
+        intersection = len(all_locations[i] & all_locations[j])
+        union = len(all_locations[i]) + len(all_locations[j]) - intersection
+        jaccard_similarity = intersection / union if union else 0
+        return (angle(i, j) + jaccard_offset) * (1 - jaccard_similarity)
+
+    return distance
+
+
+def neighbour_lists(xyz, distance, k):
+    '''
+    Each location's k nearest neighbours as (neighbour, distance) pairs,
+    sorted by the real distance, which with Jaccard weighting isn't the
+    same order as the geographic one.
+    '''
+    neighbours = []
+    for i, row in enumerate(nearest_indices(xyz, k)):
+        neighbours.append(sorted(((j, distance(i, j)) for j in row), key=lambda pair: pair[1]))
+    return neighbours
+
+
+def reverse(route, position, start, end):
+    'Reverse route[start:end+1] in place.'
+    route[start:end+1] = route[start:end+1][::-1]
+    for p in range(start, end + 1):
+        position[route[p]] = p
+
+
+def move_segment(route, position, start, length, after, flip):
+    '''
+    Move route[start:start+length] so that it follows what is now
+    route[after], optionally flipped.
+    '''
+    segment = route[start:start+length]
+    if flip:
+        segment.reverse()
+    if after > start:
+        low, high = start, after + 1
+        route[low:high] = route[start+length:after+1] + segment
+    else:
+        low, high = after + 1, start + length
+        route[low:high] = segment + route[after+1:start]
+    for p in range(low, high):
+        position[route[p]] = p
+
+
+def local_search(route, distance, neighbours, max_segment=3, epsilon=1e-9):
+    '''
+    2-opt and Or-opt (segments of up to max_segment locations) over the
+    neighbour lists until no move helps.  Changes route in place and
+    returns it.
+    '''
+    length = len(route)
+    if length < 4:
+        return route
+    last = length - 1
+    position = [0] * length
+    for p, location in enumerate(route):
+        position[location] = p
+
+    def two_opt_move(a):
+        i = position[a]
+        for forward in (True, False):
+            # Swap the edge a-b for a-c, where b is next to a and c is one
+            # of a's neighbours, and e is next to c in the same direction.
+            if forward and i == last or not forward and i == 0:
+                continue
+            b = route[i + 1] if forward else route[i - 1]
+            ab = distance(a, b)
+            for c, ac in neighbours[a]:
+                if ac >= ab - epsilon:
+                    break
+                j = position[c]
+                if forward and j == last or not forward and j == 0:
+                    continue
+                e = route[j + 1] if forward else route[j - 1]
+                if c == b or e == a:
+                    continue
+                if ac + distance(b, e) - ab - distance(c, e) < -epsilon:
+                    low, high = sorted((i, j))
+                    if forward:
+                        reverse(route, position, low + 1, high)
+                    else:
+                        reverse(route, position, low, high - 1)
+                    return (a, b, c, e)
+        return None
+
+    def or_opt_move(a):
+        i = position[a]
+        for segment_length in range(1, max_segment + 1):
+            for start in sorted(set((i, i - segment_length + 1))):
+                end = start + segment_length - 1
+                if start < 1 or end > last - 1:
+                    continue
+                first, final = route[start], route[end]
+                before, after = route[start - 1], route[end + 1]
+                removed = distance(before, first) + distance(final, after) - distance(before, after)
+                if removed <= epsilon:
+                    continue
+                # Put the segment next to one of its ends' neighbours, c,
+                # with that end touching c, on either side of c.
+                for near, far in ((first, final), (final, first)):
+                    for c, nc in neighbours[near]:
+                        if nc >= removed - epsilon:
+                            break
+                        j = position[c]
+                        if start <= j <= end:
+                            continue
+                        # c, near ... far, e
+                        if j < last and not start <= j + 1 <= end:
+                            e = route[j + 1]
+                            if nc + distance(far, e) - distance(c, e) - removed < -epsilon:
+                                move_segment(route, position, start, segment_length, j, near != first)
+                                return (a, before, after, first, final, c, e)
+                        # e, far ... near, c
+                        if j > 0 and not start <= j - 1 <= end:
+                            e = route[j - 1]
+                            if nc + distance(far, e) - distance(e, c) - removed < -epsilon:
+                                move_segment(route, position, start, segment_length, j - 1, near == first)
+                                return (a, before, after, first, final, c, e)
+        return None
+
+    # Every location starts out to be looked at.
+    active = collections.deque(route)
+    queued = [True] * length
+    while active:
+        a = active.popleft()
+        queued[a] = False
+        for move in (two_opt_move, or_opt_move):
+            touched = move(a)
+            if touched:
+                for location in touched:
+                    if not queued[location]:
+                        queued[location] = True
+                        active.append(location)
+                break
+
+    return route
+
+
+def neighbour_route(average_locations, jaccard_offset=-1, all_locations=None, neighbours=10, matrix_limit=5000):
+    # When calling this function, put desired start and end at start and
+    # end and it should keep them there.
+    xyz = unit_vectors(average_locations)
+    distance = distance_function(xyz, jaccard_offset, all_locations)
+    candidates = neighbour_lists(xyz, distance, neighbours)
+    if len(average_locations) <= matrix_limit:
+        # Small enough for the matrix, which gets the Jaccard weighting
+        # into the first route too.
+        distance_matrix = build_distance_matrix(average_locations, jaccard_offset, all_locations)
+        initial_route = nearest_neighbour(distance_matrix)
+        del distance_matrix
+    else:
+        initial_route = nearest_neighbour_points(xyz)
+    return local_search(initial_route, distance, candidates)
+
+
 def test():
     import random
     locations = [
@@ -256,11 +585,43 @@ def test():
         print()
 
 
+def benchmark(sizes=(480, 5000, 50000), repeat=1):
+    '''
+    Time the nearest neighbour constructions on random locations.  The
+    matrix ones are skipped where the matrix wouldn't fit comfortably, and
+    the old loop where it would take forever.
+    '''
+    import time
+    # Get the scipy import out of the way so that it isn't timed.
+    nearest_indices(unit_vectors([(0, 0), (1, 1)]), 1)
+    generator = random.Random(1234)
+    for size in sizes:
+        locations = [(generator.uniform(-180, 180), generator.uniform(-60, 75)) for _ in range(size)]
+        xyz = unit_vectors(locations)
+        distance = distance_function(xyz)
+        contenders = [('points', lambda: nearest_neighbour_points(xyz))]
+        if size <= 20000:
+            distance_matrix = build_distance_matrix(locations)
+            contenders.insert(0, ('matrix', lambda: nearest_neighbour(distance_matrix)))
+            if size <= 5000:
+                contenders.insert(0, ('old loop', lambda: old_nearest_neighbour(distance_matrix)))
+        for name, construct in contenders:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                route = construct()
+            seconds = (time.perf_counter() - start) / repeat
+            length = sum(distance(route[i], route[i+1]) for i in range(len(route) - 1))
+            print(f'n={size:<6} {name:<9} {seconds:9.3f}s  route {length:11.1f} degrees')
+
+
 if __name__ == '__main__':
 
     #import sys
     #print(great_circle_angle(*map(float, sys.argv[1:])))
 
-    test()
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        test()
 
 
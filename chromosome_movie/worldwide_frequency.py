@@ -1,4 +1,5 @@
 from . import svg2png
+from . import canvas
 
 class WorldwideFrequency():
 
@@ -8,25 +9,54 @@ class WorldwideFrequency():
         self.cfg = cfg
         self.layercfg = self.cfg.layers.worldwide_frequency
 
+    def radius(self, i):
+        # Scale by area.
+        return self.layercfg.max_radius * (i/self.steps)**0.5 - self.layercfg.stroke_width / 2
+
+    def origin(self):
+        '''
+        Where Composite puts this layer's (0, 0).  The layer has a center
+        but no width or height, so it's a full frame centered there, as in
+        the movie step.
+        '''
+        left = self.layercfg.center[0] - getattr(self.layercfg, 'width', self.cfg.width) / 2
+        top = self.layercfg.center[1] - getattr(self.layercfg, 'height', self.cfg.height) / 2
+        return left, top
+
+    def text(self, i, left=0, top=0):
+        percentage = round(100 * i / self.steps, 1)
+        x = self.layercfg.center[0] + self.layercfg.font_size * 2 - left
+        y = self.layercfg.center[1] + self.layercfg.max_radius + self.layercfg.font_size - top
+        return f'<text text-anchor="end" x="{x}" y="{y}" font-size="{self.layercfg.font_size}" style="{self.layercfg.text_style}">{percentage}%</text>\n'
+
     def make_svg(self, i):
         svg = f'<svg viewBox="0 0 {self.cfg.width} {self.cfg.height}" xmlns="http://www.w3.org/2000/svg">\n'
 
         # Backing circle.
         svg += f'<circle cx="{self.layercfg.center[0]}" cy="{self.layercfg.center[1]}" r="{self.layercfg.max_radius}" style="{self.layercfg.backing_style}"/>\n'
 
-        # Scale by area.
-        radius = self.layercfg.max_radius * (i/self.steps)**0.5 - self.layercfg.stroke_width / 2
-        svg += f'<circle cx="{self.layercfg.center[0]}" cy="{self.layercfg.center[1]}" r="{radius}" stroke-width="{self.layercfg.stroke_width}" style="{self.layercfg.style}"/>\n'
+        svg += f'<circle cx="{self.layercfg.center[0]}" cy="{self.layercfg.center[1]}" r="{self.radius(i)}" stroke-width="{self.layercfg.stroke_width}" style="{self.layercfg.style}"/>\n'
 
-        percentage = round(100 * i / self.steps, 1)
-        x = self.layercfg.center[0] + self.layercfg.font_size * 2
-        y = self.layercfg.center[1] + self.layercfg.max_radius + self.layercfg.font_size
-        svg += f'<text text-anchor="end" x="{x}" y="{y}" font-size="{self.layercfg.font_size}" style="{self.layercfg.text_style}">{percentage}%</text>\n'
+        svg += self.text(i)
 
         svg += '</svg>\n'
 
         return svg
 
+    def draw(self, canvas_, variant):
+        i = self.normalize(variant['worldwide_frequency'])
+        # The canvas is already transformed to the layer's origin, and the
+        # config coordinates are for the whole frame.
+        left, top = self.origin()
+        x = self.layercfg.center[0] - left
+        y = self.layercfg.center[1] - top
+        fill, stroke, stroke_width = canvas.parse_style(self.layercfg.backing_style)
+        canvas_.circle(x, y, self.layercfg.max_radius, fill, stroke, stroke_width)
+        fill, stroke, stroke_width = canvas.parse_style(self.layercfg.style, stroke_width=self.layercfg.stroke_width)
+        canvas_.circle(x, y, self.radius(i), fill, stroke, stroke_width)
+        # Text still goes through the rasterizer.
+        return self.text(i, left, top)
+
     def write_svg(self):
 
         self.layercfg.svg.parent.mkdir(parents=True, exist_ok=True)
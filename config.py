@@ -46,6 +46,12 @@ years_per_generation = 25 # 25 years per generation in latest awohns code.
 #order = 'two_world_jaccard20_30w_30s_169w_65n_max360_round5'
 #order = 'two_world_jaccard20_30w_30s_169w_65n_max240_group_limit_average_times'
 order = 'two_world_jaccard20_30w_30s_169w_65n_max480_group_limit_average_times'
+#order = 'two_world_jaccard20_30w_30s_169w_65n_max20000_group_limit_average_times'
+# Orders with 'solver': 'neighbour_lists' only try moves towards each
+# variant's nearest tsp_neighbours variants.
+tsp_neighbours = 10
+# Processes used to sort route chunks in the order step.
+order_workers = os.cpu_count()
 
 
 # Video parameters.
@@ -72,6 +78,62 @@ ffmpeg = shutil.which('ffmpeg') or r'C:\Program Files\ffmpeg\bin\ffmpeg.exe'
 #ffmpeg = r'C:\Program Files\ffmpeg\bin\ffmpeg.exe'
 #inkscape = '/usr/bin/inkscape'
 inkscape = shutil.which('inkscape') or r'C:\Program Files\Inkscape\bin\inkscape.exe'
+# Frame rendering process pool (render.py), used for Inkscape and the
+# in-process rasterizers alike.  A chunk that takes longer than
+# render_frame_timeout seconds per frame is treated as hung: the workers are
+# restarted and the chunk is retried.
+render_workers = os.cpu_count()
+render_chunk_frames = 200
+render_frame_timeout = 2
+# Keep one long-lived Inkscape per render worker instead of starting one per
+# chunk.  Frames it fails to produce within inkscape_frame_timeout seconds
+# get re-queued on their own, up to inkscape_frame_retries times (with
+# inkscape_pool off, frames from a chunk whose Inkscape fails are re-queued
+# the same way).
+inkscape_pool = True
+inkscape_recycle_frames = 1000
+inkscape_frame_timeout = 10
+inkscape_start_timeout = 30
+inkscape_frame_retries = 3
+# Only render frames whose PNG is missing, truncated, the wrong size or made
+# from a different SVG (checked against a frames.hash file kept with the
+# PNGs).  Also `run.py --resume`.
+resume = False
+# Render each distinct foreground frame once and hard-link the duplicates
+# (see cache.py).  The cache folder is shared by all parts.
+frame_cache = True
+# Foreground SVG -> PNG: 'inkscape', 'cairosvg' or 'resvg'.  See rasterize.py.
+rasterizer = 'inkscape'
+# For `run.py rasterizer_check`: per-channel difference allowed against the
+# Inkscape frames, and how many pixels may exceed it.
+rasterizer_check_frames = 20
+rasterizer_tolerance = 16
+rasterizer_max_bad_fraction = 0.002
+# Draw the dynamic foreground layers straight into pixel buffers (see
+# canvas.py) and skip the per-frame SVG files.  Whatever the layers can't draw
+# themselves is rendered in-process with canvas_rasterizer, which has to be
+# 'cairosvg' or 'resvg'.
+foreground_canvas = False
+canvas_rasterizer = 'cairosvg'
+# Layers drawn that way are rasterized once per distinct picture and kept in
+# an LRU sprite cache of this size (per process).  The margin leaves room
+# around each layer's box for drop shadows.
+sprite_cache_mb = 2048
+sprite_margin = 16
+# Keep the drawn frame between frames and only repaint the rectangles where
+# some layer changed.
+damage_tracking = True
+# Have the movie step draw foreground frames itself (as with
+# foreground_canvas) and pipe them into ffmpeg, with no PNGs on disk.  The
+# foreground step is skipped.  See stream.py.
+movie_stream = False
+stream_workers = 4
+stream_chunk_frames = 48
+# Frames each worker may have waiting; 2560x1440 RGBA is about 15MB each.
+stream_queue_frames = 4
+# Encode runs of identical foreground frames once, variable frame rate,
+# using the frame cache manifest (so needs frame_cache).
+movie_vfr = False
 timidity = shutil.which('timidity') or r'C:\Program Files (x86)\TiMidity\timidity.exe'
 
 treeseq_path = pathlib.Path(treeseq)
@@ -89,10 +151,42 @@ movie = working/'movie'
 # Collect a list of folders to create at the end.
 folders = [data, images, audio, movie]
 
+frame_cache_path = images/'frame_cache'
+
 database_path = data/f'{treeseq_path.stem}.sqlite'
 database_readonly_uri = f'file:{database_path.as_posix()}?mode=ro'
+# Shared read-only connection used by the layers while rendering.
+database_read_cache_kib = 256_000
+database_mmap_size = 4 * 1024**3
+database_cached_statements = 256
 #weighted_average_locations = False
 weighted_average_locations = True
+# Number of variants to collect before each batch of database writes.
+database_chunk_size = 10_000
+# Number of processes used to read variants from the treeseq.  Can be
+# overridden with "run.py database --workers N".
+database_workers = 1
+# Bulk load: one connection for the whole database step, no journal or
+# fsync, a large page cache, and secondary indexes dropped until the end.
+# Faster, but a crash partway through means rerunning the database step.
+database_bulk_load = True
+# OFF is fastest; WAL keeps the database readable while it loads.
+database_journal_mode = 'OFF'
+database_cache_kib = 1_000_000
+# Commit after roughly this many variant rows.
+database_commit_rows = 100_000
+# "run.py refresh" writes the population_counts_match_variant_id values whose
+# local_frequencies images need re-rendering here (all of them after a full
+# rebuild).
+database_invalidated_path = data/f'{treeseq_path.stem}.invalidated.txt'
+# Memory-mappable .npy copy of the database tables, from "run.py columns".
+columns_path = data/f'{treeseq_path.stem}.columns'
+# Have the layers look up variant populations in the memory-mapped
+# columns instead of querying SQLite for every frame.  Needs the columns step
+# to have been run since the database last changed (database, refresh or
+# recompute); the layers refuse to start otherwise, so it's off unless you
+# turn it on and rerun "run.py columns" after each of those.
+columnar_population_index = False
 
 # Adds some shadows to text and lines to make lines a little cleaner when
 # movies are resized to arbitrary sizes by the viewer, or when high-resolution
@@ -361,6 +455,13 @@ layers.chromosome_map.sections = [
 ]
 layers.chromosome_map.radius = 8
 
+# Position marker circles, outermost first: (radius, fill, stroke,
+# stroke width).
+layers.chromosome_position.circles = [
+    (16, 'orange', 'red', 4.0),
+    (4, 'black', 'rgb(160,160,160)', 3.0),
+]
+
 layers.max_local.max_radius = h(16)
 layers.max_local.stroke_width = 0
 layers.max_local.style = 'stroke:none;fill:pink;fill-opacity:1.0;'
@@ -31,10 +31,16 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('commands', nargs='+',
-            choices=['all', 'database', 'chromosome_map', 'clef', 'world_map', 'background', 'order', 'foreground', 'audio', 'movie', 'preview'])
+            choices=['all', 'database', 'refresh', 'recompute', 'chromosome_map', 'clef', 'world_map', 'background', 'order', 'columns', 'foreground', 'rasterizer_check', 'damage_check', 'audio', 'movie', 'preview'])
+    parser.add_argument('--workers', type=int, default=config.database_workers,
+            help='Number of processes to use for the database step.')
+    parser.add_argument('--resume', action='store_true', default=config.resume,
+            help='Skip frames whose PNGs are already up to date.')
     args = parser.parse_args()
 
     commands = args.commands
+    config.database_workers = args.workers
+    config.resume = args.resume
 
     #for folder in config.folders:
     #    folder.mkdir(parents=True, exist_ok=True)
@@ -43,6 +49,14 @@ if __name__ == '__main__':
         obj = chromosome_movie.database.Database(config)
         obj.write_db()
 
+    if 'refresh' in commands:
+        obj = chromosome_movie.database.Database(config)
+        obj.refresh_db()
+
+    if 'recompute' in commands:
+        obj = chromosome_movie.recompute.Recompute(config)
+        obj.write_db()
+
     if 'chromosome_map' in commands or 'all' in commands:
         obj = chromosome_movie.chromosome_map.ChromosomeMap(config)
         obj.write_db()
@@ -64,10 +78,26 @@ if __name__ == '__main__':
         obj = chromosome_movie.order.Order(config)
         obj.write_db()
 
-    if 'foreground' in commands or 'all' in commands or 'reorder' in commands:
+    if 'columns' in commands or 'all' in commands or 'reorder' in commands:
+        obj = chromosome_movie.columns.Columns(config)
+        obj.write_npy()
+
+    if ('foreground' in commands or 'all' in commands or 'reorder' in commands) and not config.movie_stream:
         obj = chromosome_movie.composite.Foreground(config)
-        obj.write_svg()
-        obj.write_png()
+        if config.foreground_canvas:
+            obj.write_canvas_png()
+        else:
+            obj.write_svg()
+            obj.write_png()
+
+    if 'rasterizer_check' in commands:
+        obj = chromosome_movie.composite.Foreground(config)
+        if not obj.check_png():
+            sys.exit(1)
+
+    if 'damage_check' in commands:
+        if not chromosome_movie.composite.check_damage():
+            sys.exit(1)
 
     if 'audio' in commands or 'all' in commands or 'reorder' in commands:
         obj = chromosome_movie.audio.Audio(config)
@@ -75,7 +105,12 @@ if __name__ == '__main__':
 
     if 'movie' in commands or 'all' in commands or 'reorder' in commands:
         obj = chromosome_movie.movie.Movie(config)
-        obj.write_bg_fg_mp4()
+        if config.movie_stream:
+            obj.write_stream_mp4()
+        elif config.movie_vfr:
+            obj.write_vfr_mp4()
+        else:
+            obj.write_bg_fg_mp4()
 
     if 'preview' in commands:
         obj = chromosome_movie.movie.Movie(config, layer_names=['average_location', 'local_frequencies'])